@@ -1,6 +1,8 @@
 import configparser
 from logging import warning
 
+import templates
+
 class WhitespaceFriendlyConfigParser(configparser.ConfigParser):
 	def get(self, section, option, *args, **kwargs):
 		val = super().get(section, option, *args, **kwargs)
@@ -11,8 +13,22 @@ class Config:
 		self.debug = False
 		self.module = None
 		self.database = None
+		self.db_journal_mode = "wal"
+		self.db_synchronous = "normal"
+		self.db_mmap_size = 268435456
+		self.db_cache_size = -16000
+		self.db_busy_timeout = 5000
+		self.db_statement_cache = 256
 		self.useragent = None
 		self.ratelimit = 1.0
+		self.pool_connections = 10
+		self.pool_maxsize = 10
+		self.host_connections = 2
+		self.fetch_workers = 8
+		self.cache_dir = "cache"
+		self.http_cache = True
+		self.http_cache_max_age = 14
+		self.http_cache_max_entries = 5000
 		
 		self.subreddit = None
 		self.r_username = None
@@ -24,11 +40,19 @@ class Config:
 		
 		self.new_show_types = list()
 		self.record_scores = False
+		self.adaptive_polling = True
+		self.release_window_before = 1
+		self.release_window_after = 6
+		self.idle_poll_interval = 3600
 		
 		self.discovery_primary_source = None
 		self.discovery_secondary_sources = list()
 		self.discovery_stream_sources = list()
 		
+		self.daemon_episode_interval = 60
+		self.daemon_update_interval = 3600
+		self.daemon_poll_score_interval = 21600
+		
 		self.post_title = None
 		self.post_title_with_en = None
 		self.post_title_postfix_final = None
@@ -55,11 +79,25 @@ def from_file(file_path):
 	if "data" in parsed:
 		sec = parsed["data"]
 		config.database = sec.get("database", None)
+		config.db_journal_mode = sec.get("journal_mode", "wal")
+		config.db_synchronous = sec.get("synchronous", "normal")
+		config.db_mmap_size = sec.getint("mmap_size", 268435456)
+		config.db_cache_size = sec.getint("cache_size", -16000)
+		config.db_busy_timeout = sec.getint("busy_timeout", 5000)
+		config.db_statement_cache = sec.getint("statement_cache", 256)
 	
 	if "connection" in parsed:
 		sec = parsed["connection"]
 		config.useragent = sec.get("useragent", None)
 		config.ratelimit = sec.getfloat("ratelimit", 1.0)
+		config.pool_connections = sec.getint("pool_connections", 10)
+		config.pool_maxsize = sec.getint("pool_maxsize", 10)
+		config.host_connections = sec.getint("host_connections", 2)
+		config.fetch_workers = sec.getint("fetch_workers", 8)
+		config.cache_dir = sec.get("cache_dir", "cache")
+		config.http_cache = sec.getboolean("http_cache", True)
+		config.http_cache_max_age = sec.getint("http_cache_max_age", 14)
+		config.http_cache_max_entries = sec.getint("http_cache_max_entries", 5000)
 	
 	if "reddit" in parsed:
 		sec = parsed["reddit"]
@@ -75,6 +113,10 @@ def from_file(file_path):
 		from data.models import str_to_showtype
 		config.new_show_types.extend(map(lambda s: str_to_showtype(s.strip()), sec.get("new_show_types", "").split(" ")))
 		config.record_scores = sec.getboolean("record_scores", False)
+		config.adaptive_polling = sec.getboolean("adaptive_polling", True)
+		config.release_window_before = sec.getint("release_window_before", 1)
+		config.release_window_after = sec.getint("release_window_after", 6)
+		config.idle_poll_interval = sec.getint("idle_poll_interval", 3600)
 	
 	if "options.discovery" in parsed:
 		sec = parsed["options.discovery"]
@@ -82,6 +124,12 @@ def from_file(file_path):
 		config.discovery_secondary_sources = sec.get("secondary_sources", "").split(" ")
 		config.discovery_stream_sources = sec.get("stream_sources", "").split(" ")
 	
+	if "daemon" in parsed:
+		sec = parsed["daemon"]
+		config.daemon_episode_interval = sec.getint("episode_interval", 60)
+		config.daemon_update_interval = sec.getint("update_interval", 3600)
+		config.daemon_poll_score_interval = sec.getint("poll_score_interval", 21600)
+	
 	if "post" in parsed:
 		sec = parsed["post"]
 		config.post_title = sec.get("title", None)
@@ -117,6 +165,29 @@ def validate(config):
 	if config.ratelimit < 0:
 		warning("Rate limit can't be negative, defaulting to 1.0")
 		config.ratelimit = 1.0
+	if config.pool_connections < 1 or config.pool_maxsize < 1:
+		warning("Connection pool sizes must be positive, defaulting to 10")
+		config.pool_connections = 10
+		config.pool_maxsize = 10
+	if config.host_connections < 1:
+		warning("Connections per host must be positive, defaulting to 2")
+		config.host_connections = 2
+	if config.fetch_workers < 1:
+		warning("Fetch workers must be positive, defaulting to 8")
+		config.fetch_workers = 8
+	if config.http_cache_max_age < 1 or config.http_cache_max_entries < 1:
+		warning("HTTP cache limits must be positive, defaulting to 14 days and 5000 entries")
+		config.http_cache_max_age = 14
+		config.http_cache_max_entries = 5000
+	if config.release_window_before < 0 or config.release_window_after < 0:
+		warning("Release windows can't be negative, defaulting to 1 hour before and 6 after")
+		config.release_window_before = 1
+		config.release_window_after = 6
+	if min(config.daemon_episode_interval, config.daemon_update_interval, config.daemon_poll_score_interval) < 1:
+		warning("Daemon intervals must be positive, using the defaults")
+		config.daemon_episode_interval = 60
+		config.daemon_update_interval = 3600
+		config.daemon_poll_score_interval = 21600
 	if is_bad_str(config.subreddit):
 		return "subreddit missing"
 	if is_bad_str(config.r_username):
@@ -131,4 +202,13 @@ def validate(config):
 		return "post title missing"
 	if is_bad_str(config.post_body):
 		return "post title missing"
+	
+	# Compiled once here, posts and edits reuse the compiled templates
+	for template in (config.post_title, config.post_title_with_en, config.post_body,
+					 config.batch_thread_post_title, config.batch_thread_post_title_with_en, config.batch_thread_post_body):
+		if not is_bad_str(template):
+			try:
+				templates.compile_template(template)
+			except ValueError as e:
+				return "invalid post template: {}".format(e)
 	return False
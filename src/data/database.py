@@ -1,21 +1,44 @@
-from logging import debug, error, exception
-import sqlite3, re
-from functools import wraps, lru_cache
+from logging import debug, info, error, exception
+import sqlite3, re, itertools
+from functools import wraps
+from contextlib import contextmanager
 from unidecode import unidecode
-from typing import Set, List, Optional
+from typing import Set, List, Dict, Tuple, Optional
 from datetime import datetime, timezone
 
-from .models import Show, ShowType, Stream, LiteStream, Service, LinkSite, Link, Episode, EpisodeScore, UnprocessedStream, UnprocessedShow, PollSite, Poll
+from .models import Show, ShowType, Stream, LiteStream, Service, LinkSite, Link, Episode, LatestEpisodes, PostEdit, EpisodeScore, UnprocessedStream, UnprocessedShow, PollSite, Poll
 
-def living_in(the_database):
+_journal_modes = {"delete", "truncate", "persist", "memory", "wal", "off"}
+_synchronous_levels = {"off", "normal", "full", "extra"}
+
+def living_in(the_database, journal_mode="wal", synchronous="normal", mmap_size=268435456, cache_size=-16000, busy_timeout=5000, statement_cache=256):
 	"""
 	wow wow
 	:param the_database:
+	:param journal_mode: SQLite journal mode, WAL lets readers and the writer run at the same time
+	:param synchronous: SQLite synchronous level, normal is safe with WAL
+	:param mmap_size: Bytes of the database file memory-mapped for reads
+	:param cache_size: Page cache size, in pages if positive or KiB if negative
+	:param busy_timeout: Milliseconds to wait for a lock held by another connection
+	:param statement_cache: Number of prepared statements kept by the connection
 	:return:
 	"""
+	journal_mode = journal_mode.lower()
+	synchronous = synchronous.lower()
+	if journal_mode not in _journal_modes:
+		error("Invalid journal mode {}, using wal".format(journal_mode))
+		journal_mode = "wal"
+	if synchronous not in _synchronous_levels:
+		error("Invalid synchronous level {}, using normal".format(synchronous))
+		synchronous = "normal"
+	
 	try:
-		db = sqlite3.connect(the_database)
+		db = sqlite3.connect(the_database, timeout=busy_timeout / 1000, cached_statements=statement_cache)
 		db.execute("PRAGMA foreign_keys=ON")
+		db.execute("PRAGMA journal_mode={}".format(journal_mode))
+		db.execute("PRAGMA synchronous={}".format(synchronous))
+		db.execute("PRAGMA mmap_size={:d}".format(mmap_size))
+		db.execute("PRAGMA cache_size={:d}".format(cache_size))
 	except sqlite3.OperationalError:
 		error("Failed to open database, {}".format(the_database))
 		return None
@@ -23,6 +46,8 @@ def living_in(the_database):
 
 # Database
 
+# Inside a transaction block, exceptions are raised again after being logged so the block is rolled back
+
 def db_error(f):
 	@wraps(f)
 	def protected(*args, **kwargs):
@@ -31,6 +56,8 @@ def db_error(f):
 			return True
 		except:
 			exception("Database exception thrown")
+			if _in_transaction(args):
+				raise
 			return False
 	return protected
 
@@ -45,17 +72,22 @@ def db_error_default(default_value):
 				return f(*args, **kwargs)
 			except:
 				exception("Database exception thrown")
+				if _in_transaction(args):
+					raise
 				return value
 		return protected
 	return decorate
 
+def _in_transaction(args):
+	return len(args) > 0 and getattr(args[0], "_transaction_depth", 0) > 0
+
 class DatabaseDatabase:
 	def __init__(self, db):
 		self._db = db
 		self.q = db.cursor()
-
-		# Set up collations
-		self._db.create_collation("alphanum", _collate_alphanum)
+		self._transaction_depth = 0
+		self._show_revisions = dict()		# show id -> revision, never cleared
+		self.clear_cache()
 
 	def __getattr__(self, attr):
 		if attr in self.__dict__:
@@ -68,6 +100,114 @@ class DatabaseDatabase:
 	def save(self):
 		self.commit()
 
+	def commit(self):
+		"""
+		Commits pending writes. Inside a transaction block, the commit is left to the end of the outermost block.
+		"""
+		if self._transaction_depth > 0:
+			return
+		self._db.commit()
+
+	@contextmanager
+	def transaction(self):
+		"""
+		Context manager grouping all writes made in the block into a single commit.
+		Nested blocks are savepoints: an exception rolls back the writes of the block it was raised in, then propagates.
+		Usage:
+			with db.transaction():
+				db.add_episode(...)
+		"""
+		depth = self._transaction_depth
+		savepoint = "holo_{}".format(depth)
+		if depth == 0:
+			if not self._db.in_transaction:
+				self.q.execute("BEGIN")
+		else:
+			self.q.execute("SAVEPOINT " + savepoint)
+		self._transaction_depth += 1
+		try:
+			yield self
+		except:
+			self._transaction_depth = depth
+			# Rows loaded since the block began may hold the rolled back writes
+			self.clear_cache()
+			if depth == 0:
+				self._db.rollback()
+			else:
+				self.q.execute("ROLLBACK TO " + savepoint)
+				self.q.execute("RELEASE " + savepoint)
+			raise
+		self._transaction_depth = depth
+		if depth == 0:
+			self._db.commit()
+		else:
+			self.q.execute("RELEASE " + savepoint)
+
+	# Identity map
+	def clear_cache(self):
+		"""
+		Forgets all shows and registry rows loaded so far, so the next reads query the database again.
+		Long-running processes call this between runs.
+		"""
+		self._shows = dict()			# show id -> Show
+		self._registries = dict()		# table -> {"id": {id: model}, "key": {key: model}}
+
+	def _get_registry(self, table):
+		"""
+		Loads every row of a small registry table (Services, LinkSites, PollSites) once.
+		"""
+		registry = self._registries.get(table)
+		if registry is None:
+			columns, model = _registry_tables[table]
+			self.q.execute("SELECT {} FROM {}".format(columns, table))
+			rows = [model(*row) for row in self.q.fetchall()]
+			registry = {"id": {row.id: row for row in rows}, "key": {row.key: row for row in rows}}
+			self._registries[table] = registry
+		return registry
+
+	def _get_registry_entry(self, table, id=None, key=None):
+		if id is not None:
+			# IDs may come as strings from the command line
+			if isinstance(id, str) and id.isdigit():
+				id = int(id)
+			return self._get_registry(table)["id"].get(id)
+		if key is not None:
+			return self._get_registry(table)["key"].get(key)
+		return None
+
+	def _get_registry_entries(self, table, enabled=True, disabled=False):
+		return [row for row in self._get_registry(table)["id"].values() if (enabled and row.enabled) or (disabled and not row.enabled)]
+
+	def _to_shows(self, rows) -> List[Show]:
+		"""
+		Converts Shows rows to models, reusing the models of shows already loaded.
+		Aliases are only loaded for shows not seen before.
+		"""
+		shows = list()
+		new_shows = list()
+		for row in rows:
+			show = self._shows.get(row[0])
+			if show is None:
+				show = Show(*row)
+				self._shows[show.id] = show
+				new_shows.append(show)
+			shows.append(show)
+		self._load_aliases(new_shows)
+		return shows
+
+	def _forget_show(self, show_id):
+		self._shows.pop(show_id, None)
+
+	def get_show_revision(self, show: Show) -> int:
+		"""
+		Gets a number that changes whenever an episode or poll of the show is written through this object.
+		Used to know when text generated from them must be generated again.
+		"""
+		return self._show_revisions.get(show.id, 0)
+
+	def _bump_show_revision(self, show_id):
+		self._show_revisions[show_id] = next(_revisions)
+
 	# Setup
 	def setup_tables(self):
 		self.q.execute("""CREATE TABLE IF NOT EXISTS ShowTypes (
@@ -182,6 +322,36 @@ class DatabaseDatabase:
 		)""")
 
 		self.commit()
+		self.migrate()
+
+	# Migrations
+	def get_schema_version(self) -> int:
+		self.q.execute("PRAGMA user_version")
+		return self.get_count()
+
+	def migrate(self) -> bool:
+		"""
+		Applies the migrations newer than the schema version recorded in the database.
+		Each migration runs in its own transaction with the version update, so an interrupted
+		migration is retried entirely on the next setup.
+		:return: True if the schema is up to date
+		"""
+		version = self.get_schema_version()
+		for number, migration in enumerate(_migrations, start=1):
+			if number <= version:
+				continue
+			info("Applying database migration {}: {}".format(number, migration.__doc__.strip()))
+			try:
+				self.commit()
+				self.q.execute("BEGIN")
+				migration(self.q)
+				self.q.execute("PRAGMA user_version = {:d}".format(number))
+				self.commit()
+			except:
+				exception("Database migration {} failed".format(number))
+				self.rollback()
+				return False
+		return True
 
 	def register_services(self, services):
 		self.q.execute("UPDATE Services SET enabled = 0")
@@ -189,6 +359,7 @@ class DatabaseDatabase:
 			service = services[service_key]
 			self.q.execute("INSERT OR IGNORE INTO Services (key, name) VALUES (?, '')", (service.key,))
 			self.q.execute("UPDATE Services SET name = ?, enabled = 1 WHERE key = ?", (service.name, service.key))
+		self._registries.pop("Services", None)
 		self.commit()
 
 	def register_link_sites(self, sites):
@@ -197,40 +368,27 @@ class DatabaseDatabase:
 			site = sites[site_key]
 			self.q.execute("INSERT OR IGNORE INTO LinkSites (key, name) VALUES (?, '')", (site.key,))
 			self.q.execute("UPDATE LinkSites SET name = ?, enabled = 1 WHERE key = ?", (site.name, site.key))
+		self._registries.pop("LinkSites", None)
 		self.commit()
 
 	def register_poll_sites(self, polls):
 		for poll_key in polls:
 			poll = polls[poll_key]
 			self.q.execute("INSERT OR IGNORE INTO PollSites (key) VALUES (?)", (poll.key,))
+		self._registries.pop("PollSites", None)
 		self.commit()
 
 	# Services
 	@db_error_default(None)
-	@lru_cache(10)
 	def get_service(self, id=None, key=None) -> Optional[Service]:
-		if id is not None:
-			self.q.execute("SELECT id, key, name, enabled, use_in_post FROM Services WHERE id = ?", (id,))
-		elif key is not None:
-			self.q.execute("SELECT id, key, name, enabled, use_in_post FROM Services WHERE key = ?", (key,))
-		else:
+		if id is None and key is None:
 			error("ID or key required to get service")
 			return None
-		service = self.q.fetchone()
-		return Service(*service)
+		return self._get_registry_entry("Services", id=id, key=key)
 
 	@db_error_default(list())
 	def get_services(self, enabled=True, disabled=False) -> List[Service]:
-		services = list()
-		if enabled:
-			self.q.execute("SELECT id, key, name, enabled, use_in_post FROM Services WHERE enabled = 1")
-			for service in self.q.fetchall():
-				services.append(Service(*service))
-		if disabled:
-			self.q.execute("SELECT id, key, name, enabled, use_in_post FROM Services WHERE enabled = 0")
-			for service in self.q.fetchall():
-				services.append(Service(*service))
-		return services
+		return self._get_registry_entries("Services", enabled=enabled, disabled=disabled)
 
 	@db_error_default(None)
 	def get_stream(self, id=None, service_tuple=None) -> Optional[Stream]:
@@ -263,32 +421,33 @@ class DatabaseDatabase:
 	@db_error_default(list())
 	def get_streams(self, service=None, show=None, unmatched=False, missing_name=False) -> List[Stream]:
 		# Not the best combination of options, but it's only the usage needed
+		# Shows are joined so each stream's show is loaded with the same query
+		select = "SELECT stream.id, stream.service, stream.show, stream.show_id, stream.show_key, stream.name, stream.remote_offset, stream.display_offset, stream.active, stream.last_checked, \
+				  show.id, show.name, show.name_en, show.length, show.type, show.has_source, show.is_nsfw, show.enabled, show.delayed \
+				  FROM Streams stream LEFT JOIN Shows show ON show.id = stream.show"
 		if service is not None:
 			debug("Getting all active streams for service {}".format(service.key))
 			service = self.get_service(key=service.key)
-			self.q.execute("SELECT id, service, show, show_id, show_key, name, remote_offset, display_offset, active FROM Streams \
-							WHERE service = ? AND active = 1 AND \
-							(SELECT enabled FROM Shows WHERE id = show) = 1", (service.id,))
+			self.q.execute(select + " WHERE stream.service = ? AND stream.active = 1 AND show.enabled = 1", (service.id,))
 		elif show is not None:
 			debug("Getting all streams for show {}".format(show.id))
-			self.q.execute("SELECT id, service, show, show_id, show_key, name, remote_offset, display_offset, active FROM Streams \
-							WHERE show = ? AND (SELECT enabled FROM Shows WHERE id = show) = 1", (show.id,))
+			self.q.execute(select + " WHERE stream.show = ? AND show.enabled = 1", (show.id,))
 		elif unmatched:
 			debug("Getting unmatched streams")
-			self.q.execute("SELECT id, service, show, show_id, show_key, name, remote_offset, display_offset, active FROM Streams \
-							WHERE show IS NULL")
+			self.q.execute(select + " WHERE stream.show IS NULL")
 		elif missing_name:
-			self.q.execute("SELECT id, service, show, show_id, show_key, name, remote_offset, display_offset, active FROM Streams \
-							WHERE (name IS NULL OR name = '') AND active = 1 AND \
-							(SELECT enabled FROM Shows WHERE id = show) = 1")
+			self.q.execute(select + " WHERE (stream.name IS NULL OR stream.name = '') AND stream.active = 1 AND show.enabled = 1")
 		else:
 			error("A service or show must be provided to get streams")
 			return list()
 
-		streams = self.q.fetchall()
-		streams = [Stream(*stream) for stream in streams]
-		for stream in streams:
-			stream.show = self.get_show(id=stream.show) # convert show id to show model
+		rows = self.q.fetchall()
+		shows = iter(self._to_shows([row[10:] for row in rows if row[10] is not None]))
+		streams = list()
+		for row in rows:
+			stream = Stream(*row[:10])
+			stream.show = next(shows) if row[10] is not None else None		# convert show id to show model
+			streams.append(stream)
 		return streams
 
 	@db_error_default(False)
@@ -326,6 +485,12 @@ class DatabaseDatabase:
 		if commit:
 			self.commit()
 
+	@db_error
+	def set_streams_checked(self, streams, timestamp, commit=True):
+		self.q.executemany("UPDATE Streams SET last_checked = ? WHERE id = ?", [(timestamp, stream.id) for stream in streams])
+		if commit:
+			self.commit()
+
 	#Infos
 	@db_error_default(list())
 	def get_lite_streams(self, service=None, show=None, missing_link=False) -> List[LiteStream]:
@@ -350,38 +515,23 @@ class DatabaseDatabase:
 		return lite_streams
 
 	@db_error
-	def add_lite_stream(self, show, service, service_name, url):
+	def add_lite_stream(self, show, service, service_name, url, commit=True):
 		debug(f"Inserting lite stream {service} ({url}) for show {show}")
 		self.q.execute("INSERT INTO LiteStreams (show, service, service_name, url) values (?, ?, ?, ?)", (show, service, service_name, url))
-		self.commit()
+		if commit:
+			self.commit()
 
 	# Links
 	@db_error_default(None)
 	def get_link_site(self, id:str=None, key:str=None) -> Optional[LinkSite]:
-		if id is not None:
-			self.q.execute("SELECT id, key, name, enabled FROM LinkSites WHERE id = ?", (id,))
-		elif key is not None:
-			self.q.execute("SELECT id, key, name, enabled FROM LinkSites WHERE key = ?", (key,))
-		else:
+		if id is None and key is None:
 			error("ID or key required to get link site")
 			return None
-		site = self.q.fetchone()
-		if site is None:
-			return None
-		return LinkSite(*site)
+		return self._get_registry_entry("LinkSites", id=id, key=key)
 
 	@db_error_default(list())
 	def get_link_sites(self, enabled=True, disabled=False) -> List[LinkSite]:
-		sites = list()
-		if enabled:
-			self.q.execute("SELECT id, key, name, enabled FROM LinkSites WHERE enabled = 1")
-			for link in self.q.fetchall():
-				sites.append(LinkSite(*link))
-		if disabled:
-			self.q.execute("SELECT id, key, name, enabled FROM LinkSites WHERE enabled = 0")
-			for link in self.q.fetchall():
-				sites.append(LinkSite(*link))
-		return sites
+		return self._get_registry_entries("LinkSites", enabled=enabled, disabled=disabled)
 
 	@db_error_default(list())
 	def get_links(self, show:Show=None) -> List[Link]:
@@ -437,7 +587,6 @@ class DatabaseDatabase:
 	# Shows
 	@db_error_default(list())
 	def get_shows(self, missing_length=False, missing_stream=False, enabled=True, delayed=False) -> [Show]:
-		shows = list()
 		if missing_length:
 			self.q.execute(
 				"SELECT id, name, name_en, length, type, has_source, is_nsfw, enabled, delayed FROM Shows \
@@ -460,11 +609,7 @@ class DatabaseDatabase:
 			self.q.execute(
 				"SELECT id, name, name_en, length, type, has_source, is_nsfw, enabled, delayed FROM Shows \
 				WHERE enabled = ?", (enabled,))
-		for show in self.q.fetchall():
-			show = Show(*show)
-			show.aliases = self.get_aliases(show)
-			shows.append(show)
-		return shows
+		return self._to_shows(self.q.fetchall())
 
 	@db_error_default(None)
 	def get_show(self, id=None, stream=None) -> Optional[Show]:
@@ -478,15 +623,15 @@ class DatabaseDatabase:
 		if id is None:
 			error("Show ID not provided to get_show")
 			return None
+		if id in self._shows:
+			return self._shows[id]
 		self.q.execute(
 			"SELECT id, name, name_en, length, type, has_source, is_nsfw, enabled, delayed FROM Shows \
 			WHERE id = ?", (id,))
 		show = self.q.fetchone()
 		if show is None:
 			return None
-		show = Show(*show)
-		show.aliases = self.get_aliases(show)
-		return show
+		return self._to_shows([show])[0]
 
 	@db_error_default(None)
 	def get_show_by_name(self, name) -> Optional[Show]:
@@ -498,15 +643,28 @@ class DatabaseDatabase:
 		show = self.q.fetchone()
 		if show is None:
 			return None
-		show = Show(*show)
-		show.aliases = self.get_aliases(show)
-		return show
+		return self._to_shows([show])[0]
 
 	@db_error_default(list())
 	def get_aliases(self, show: Show) -> [str]:
 		self.q.execute("SELECT alias FROM Aliases where show = ?", (show.id,))
 		return [s for s, in self.q.fetchall()]
 
+	def _load_aliases(self, shows):
+		"""
+		Sets the aliases of many shows with one query per chunk of shows instead of one per show.
+		"""
+		shows = list(shows)
+		aliases = {show.id: list() for show in shows}
+		show_ids = list(aliases.keys())
+		for i in range(0, len(show_ids), 500):
+			chunk = show_ids[i:i+500]
+			self.q.execute("SELECT show, alias FROM Aliases WHERE show IN ({})".format(", ".join("?" * len(chunk))), chunk)
+			for show_id, alias in self.q.fetchall():
+				aliases[show_id].append(alias)
+		for show in shows:
+			show.aliases = aliases[show.id]
+
 	@db_error_default(None)
 	def add_show(self, raw_show: UnprocessedShow, commit=True) -> int:
 		debug("Inserting show: {}".format(raw_show))
@@ -528,6 +686,7 @@ class DatabaseDatabase:
 	@db_error
 	def add_alias(self, show_id: int, alias: str, commit=True):
 		self.q.execute("INSERT INTO Aliases (show, alias) VALUES (?, ?)", (show_id, alias))
+		self._forget_show(show_id)
 		if commit:
 			self.commit()
 
@@ -547,32 +706,38 @@ class DatabaseDatabase:
 		if length != 0:
 			self.q.execute("UPDATE Shows SET length = ? WHERE id = ?", (length, show_id))
 		self.q.execute("UPDATE Shows SET type = ?, has_source = ?, is_nsfw = ? WHERE id = ?", (show_type, has_source, is_nsfw, show_id))
+		self._forget_show(show_id)
 
 		if commit:
 			self.commit()
 
 	@db_error
 	def add_show_names(self, *names, id=None, commit=True):
-		self.q.executemany("INSERT INTO ShowNames (show, name) VALUES (?, ?)", [(id, name) for name in names])
+		self.q.executemany("INSERT INTO ShowNames (show, name, name_norm) VALUES (?, ?, ?)", [(id, name, _alphanum_convert(name)) for name in names])
 		if commit:
 			self.commit()
 
 	@db_error
-	def set_show_episode_count(self, show, length):
+	def set_show_episode_count(self, show, length, commit=True):
 		debug("Updating show episode count in database: {}, {}".format(show.name, length))
 		self.q.execute("UPDATE Shows SET length = ? WHERE id = ?", (length, show.id))
-		self.commit()
+		self._forget_show(show.id)
+		if commit:
+			self.commit()
 
 	@db_error
-	def set_show_delayed(self, show: Show, delayed=True):
+	def set_show_delayed(self, show: Show, delayed=True, commit=True):
 		debug("Marking show {} as delayed: {}".format(show.name, delayed))
 		self.q.execute("UPDATE Shows SET delayed = ? WHERE id = ?", (delayed, show.id))
-		self.commit()
+		self._forget_show(show.id)
+		if commit:
+			self.commit()
 
 	@db_error
 	def set_show_enabled(self, show: Show, enabled=True, commit=True):
 		debug("Marking show {} as {}".format(show.name, "enabled" if enabled else "disabled"))
 		self.q.execute("UPDATE Shows SET enabled = ? WHERE id = ?", (enabled, show.id))
+		self._forget_show(show.id)
 		if commit:
 			self.commit()
 
@@ -592,11 +757,37 @@ class DatabaseDatabase:
 			return Episode(data[0], None, data[1], None)
 		return None
 
+	@db_error_default(None)
+	def get_latest_episodes(self) -> Optional[LatestEpisodes]:
+		"""
+		Loads the latest episode of every enabled show in a single query.
+		:return: A snapshot of the latest episodes, or None if it couldn't be loaded
+		"""
+		# SQLite takes the bare post_url column from the row holding the MAX
+		self.q.execute("SELECT E.show, MAX(E.episode), E.post_url FROM Episodes E \
+				JOIN Shows S ON S.id = E.show WHERE S.enabled = 1 GROUP BY E.show")
+		episodes = {show_id: Episode(number, None, post_url, None) for show_id, number, post_url in self.q.fetchall()}
+		return LatestEpisodes(episodes)
+
 	@db_error
-	def add_episode(self, show, episode_num, post_url):
+	def add_episode(self, show, episode_num, post_url, post_digest=None, commit=True):
 		debug("Inserting episode {} for show {} ({})".format(episode_num, show.id, post_url))
-		self.q.execute("INSERT INTO Episodes (show, episode, post_url) VALUES (?, ?, ?)", (show.id, episode_num, post_url))
-		self.commit()
+		self.q.execute("INSERT INTO Episodes (show, episode, post_url, post_digest) VALUES (?, ?, ?, ?)", (show.id, episode_num, post_url, post_digest))
+		self._bump_show_revision(show.id)
+		if commit:
+			self.commit()
+
+	@db_error_default(None)
+	def get_post_digest(self, show: Show, episode: Episode) -> Optional[str]:
+		self.q.execute("SELECT post_digest FROM Episodes WHERE show = ? AND episode = ?", (show.id, episode.number))
+		data = self.q.fetchone()
+		return data[0] if data is not None else None
+
+	@db_error
+	def set_post_digest(self, show: Show, episode: Episode, post_digest, commit=True):
+		self.q.execute("UPDATE Episodes SET post_digest = ? WHERE show = ? AND episode = ?", (post_digest, show.id, episode.number))
+		if commit:
+			self.commit()
 
 	@db_error_default(list())
 	def get_episodes(self, show, ensure_sorted=True) -> List[Episode]:
@@ -609,6 +800,78 @@ class DatabaseDatabase:
 			episodes = sorted(episodes, key=lambda e: e.number)
 		return episodes
 
+	# Release times
+	@db_error_default(dict())
+	def get_release_times(self) -> Dict[int, List[Tuple[int, int, int]]]:
+		"""
+		Loads the release times recorded for every enabled show.
+		:return: A dict of show IDs to lists of (weekday, hour, count), in UTC
+		"""
+		release_times = dict()
+		self.q.execute("SELECT R.show, R.weekday, R.hour, R.count FROM ReleaseTimes R \
+				JOIN Shows S ON S.id = R.show WHERE S.enabled = 1")
+		for show_id, weekday, hour, count in self.q.fetchall():
+			release_times.setdefault(show_id, list()).append((weekday, hour, count))
+		return release_times
+
+	@db_error
+	def add_release_time(self, show: Show, date: datetime, commit=True):
+		debug("Recording release time of show {}: {}".format(show.id, date))
+		self.q.execute("INSERT OR IGNORE INTO ReleaseTimes (show, weekday, hour) VALUES (?, ?, ?)", (show.id, date.weekday(), date.hour))
+		self.q.execute("UPDATE ReleaseTimes SET count = count + 1 WHERE show = ? AND weekday = ? AND hour = ?", (show.id, date.weekday(), date.hour))
+		if commit:
+			self.commit()
+
+	# Post edits
+	@db_error
+	def queue_post_edit(self, show: Show, episode: Episode, post_url, body, post_digest, commit=True):
+		"""
+		Queues the new body of a post. An edit of the same post still queued is replaced,
+		unless it has the same body, in which case it's kept with its failed attempts.
+		"""
+		self.q.execute("SELECT body FROM PostEdits WHERE post_url = ?", (post_url,))
+		queued = self.q.fetchone()
+		if queued is not None and queued[0] == body:
+			debug("Edit of post {} already queued".format(post_url))
+			return
+		debug("Queueing edit of post {}".format(post_url))
+		self.q.execute("INSERT INTO PostEdits (show, episode, post_url, body, post_digest) VALUES (?, ?, ?, ?, ?)",
+					   (show.id, episode.number, post_url, body, post_digest))
+		if commit:
+			self.commit()
+
+	@db_error
+	def cancel_post_edit(self, post_url, commit=True):
+		self.q.execute("DELETE FROM PostEdits WHERE post_url = ?", (post_url,))
+		if commit:
+			self.commit()
+
+	@db_error_default(list())
+	def get_post_edits(self) -> List[PostEdit]:
+		self.q.execute("SELECT id, show, episode, post_url, body, post_digest, attempts FROM PostEdits ORDER BY id")
+		return [PostEdit(*edit) for edit in self.q.fetchall()]
+
+	@db_error_default(None)
+	def get_post_edit(self, id) -> Optional[PostEdit]:
+		self.q.execute("SELECT id, show, episode, post_url, body, post_digest, attempts FROM PostEdits WHERE id = ?", (id,))
+		edit = self.q.fetchone()
+		if edit is None:
+			return None
+		return PostEdit(*edit)
+
+	@db_error
+	def remove_post_edit(self, edit: PostEdit, commit=True):
+		# Removed by ID so a newer edit queued for the same post in the meantime is kept
+		self.q.execute("DELETE FROM PostEdits WHERE id = ?", (edit.id,))
+		if commit:
+			self.commit()
+
+	@db_error
+	def add_post_edit_attempt(self, edit: PostEdit, commit=True):
+		self.q.execute("UPDATE PostEdits SET attempts = attempts + 1 WHERE id = ?", (edit.id,))
+		if commit:
+			self.commit()
+
 	# Scores
 	@db_error_default(list())
 	def get_show_scores(self, show: Show) -> List[EpisodeScore]:
@@ -633,7 +896,7 @@ class DatabaseDatabase:
 
 	@db_error
 	def add_episode_score(self, show: Show, episode: Episode, site: LinkSite, score: float, commit=True):
-		self.q.execute("INSERT INTO Scores (show, episode, site, score) VALUES (?, ?, ?, ?)", (show.id, episode.number, site.id, score))
+		self.q.execute("INSERT OR REPLACE INTO Scores (show, episode, site, score) VALUES (?, ?, ?, ?)", (show.id, episode.number, site.id, score))
 		if commit:
 			self.commit()
 
@@ -641,28 +904,23 @@ class DatabaseDatabase:
 
 	@db_error_default(None)
 	def get_poll_site(self, id:str=None, key:str=None) -> Optional[PollSite]:
-		if id is not None:
-			self.q.execute("SELECT id, key FROM PollSites WHERE id = ?", (id,))
-		elif key is not None:
-			self.q.execute("SELECT id, key FROM PollSites WHERE key = ?", (key,))
-		else:
+		if id is None and key is None:
 			error("ID or key required to get poll site")
 			return None
-		site = self.q.fetchone()
-		if site is None:
-			return None
-		return PollSite(*site)
+		return self._get_registry_entry("PollSites", id=id, key=key)
 
 	@db_error
 	def add_poll(self, show: Show, episode: Episode, site: PollSite, poll_id, commit=True):
 		ts = int(datetime.now(timezone.utc).timestamp())
 		self.q.execute("INSERT INTO Polls (show, episode, poll_service, poll_id, timestamp) VALUES (?, ?, ?, ?, ?)", (show.id, episode.number, site.id, poll_id, ts))
+		self._bump_show_revision(show.id)
 		if commit:
 			self.commit()
 
 	@db_error
 	def update_poll_score(self, poll: Poll, score, commit=True):
 		self.q.execute("UPDATE Polls SET score = ? WHERE show = ? AND episode = ?", (score, poll.show_id, poll.episode))
+		self._bump_show_revision(poll.show_id)
 		if commit:
 			self.commit()
 
@@ -697,13 +955,86 @@ class DatabaseDatabase:
 			if exact:
 				self.q.execute("SELECT show, name FROM ShowNames WHERE name = ?", (name,))
 			else:
-				self.q.execute("SELECT show, name FROM ShowNames WHERE name = ? COLLATE alphanum", (name,))
+				self.q.execute("SELECT show, name FROM ShowNames WHERE name_norm = ?", (_alphanum_convert(name),))
 			matched = self.q.fetchall()
 			for match in matched:
 				debug("  Found match: {} | {}".format(match[0], match[1]))
 				shows.add(match[0])
 		return shows
 
+_revisions = itertools.count(1)
+
+# Columns and model of the registry tables loaded whole by DatabaseDatabase._get_registry
+_registry_tables = {
+	"Services": ("id, key, name, enabled, use_in_post", Service),
+	"LinkSites": ("id, key, name, enabled", LinkSite),
+	"PollSites": ("id, key", PollSite),
+}
+
+# Migrations
+# Applied in order by DatabaseDatabase.migrate, the schema version is the number of migrations applied.
+# Never edit or reorder a migration once released, append a new one instead.
+
+def _migration_indexes(q):
+	"""Add indexes for stream, link, score, name and unscored poll lookups"""
+	q.execute("CREATE INDEX IF NOT EXISTS ix_Streams_service_show_key ON Streams (service, show_key)")
+	q.execute("CREATE INDEX IF NOT EXISTS ix_Streams_show ON Streams (show)")
+	q.execute("CREATE INDEX IF NOT EXISTS ix_Links_show_site ON Links (show, site, site_key)")
+	q.execute("CREATE INDEX IF NOT EXISTS ix_Links_site_site_key ON Links (site, site_key)")
+	q.execute("CREATE INDEX IF NOT EXISTS ix_ShowNames_name ON ShowNames (name, show)")
+	q.execute("CREATE INDEX IF NOT EXISTS ix_Polls_missing_score ON Polls (show) WHERE score IS NULL")
+	# Aliases (show, alias), Episodes (show, episode) and Polls (show, episode) are already indexed by their unique constraints
+
+	# Scores had no constraint, keep the most recent score of each site for an episode
+	q.execute("DELETE FROM Scores WHERE rowid NOT IN (SELECT MAX(rowid) FROM Scores GROUP BY show, episode, site)")
+	q.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_Scores_show_episode_site ON Scores (show, episode, site)")
+
+def _migration_normalized_names(q):
+	"""Store normalized show names so loose name searches use an index"""
+	q.execute("ALTER TABLE ShowNames ADD COLUMN name_norm TEXT")
+	q.execute("SELECT rowid, name FROM ShowNames")
+	q.executemany("UPDATE ShowNames SET name_norm = ? WHERE rowid = ?", [(_alphanum_convert(name), rowid) for rowid, name in q.fetchall()])
+	q.execute("CREATE INDEX IF NOT EXISTS ix_ShowNames_name_norm ON ShowNames (name_norm, show)")
+
+def _migration_post_digests(q):
+	"""Store the digest of each post body so unchanged posts aren't edited"""
+	q.execute("ALTER TABLE Episodes ADD COLUMN post_digest TEXT")
+
+def _migration_post_edits(q):
+	"""Add a queue of post edits applied at the end of runs"""
+	q.execute("""CREATE TABLE IF NOT EXISTS PostEdits (
+		id		INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+		show		INTEGER NOT NULL,
+		episode		INTEGER NOT NULL,
+		post_url	TEXT NOT NULL UNIQUE ON CONFLICT REPLACE,
+		body		TEXT NOT NULL,
+		post_digest	TEXT NOT NULL,
+		attempts	INTEGER NOT NULL DEFAULT 0,
+		FOREIGN KEY(show) REFERENCES Shows(id)
+	)""")
+
+def _migration_release_times(q):
+	"""Record when shows are released and when streams were last checked"""
+	q.execute("""CREATE TABLE IF NOT EXISTS ReleaseTimes (
+		show		INTEGER NOT NULL,
+		weekday		INTEGER NOT NULL,
+		hour		INTEGER NOT NULL,
+		count		INTEGER NOT NULL DEFAULT 0,
+		UNIQUE(show, weekday, hour) ON CONFLICT IGNORE,
+		FOREIGN KEY(show) REFERENCES Shows(id)
+	)""")
+	q.execute("ALTER TABLE Streams ADD COLUMN last_checked INTEGER")
+
+_migrations = [
+	_migration_indexes,
+	_migration_normalized_names,
+	_migration_post_digests,
+	_migration_post_edits,
+	_migration_release_times,
+]
+
+SCHEMA_VERSION = len(_migrations)
+
 # Helper methods
 
 ## Conversions
@@ -719,18 +1050,7 @@ def from_show_type(st: ShowType) -> Optional[str]:
 		return None
 	return st.value
 
-## Collations
-
-def _collate_alphanum(str1, str2):
-	str1 = _alphanum_convert(str1)
-	str2 = _alphanum_convert(str2)
-
-	if str1 == str2:
-		return 0
-	elif str1 < str2:
-		return -1
-	else:
-		return 1
+## Name normalization
 
 _alphanum_regex = re.compile("[^a-zA-Z0-9]+")
 _romanization_o = re.compile("\bwo\b")
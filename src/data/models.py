@@ -73,6 +73,39 @@ class Episode:
 		now = datetime.now() if local else datetime.utcnow()
 		return now >= self.date
 
+class LatestEpisodes:
+	"""
+	Snapshot of the latest posted episode of each show, loaded once per run.
+	Kept up to date in memory as new episodes are posted.
+	"""
+	def __init__(self, episodes):
+		self._episodes = episodes		# show id -> Episode
+	
+	def get(self, show):
+		return self._episodes.get(show.id)
+	
+	def update(self, show, episode):
+		latest = self._episodes.get(show.id)
+		if latest is None or episode.number > latest.number:
+			self._episodes[show.id] = episode
+	
+	def __len__(self):
+		return len(self._episodes)
+
+class PostEdit:
+	def __init__(self, id, show_id, episode, post_url, body, post_digest, attempts):
+		# Note: arguments are order-sensitive
+		self.id = id
+		self.show_id = show_id
+		self.episode = episode
+		self.post_url = post_url
+		self.body = body
+		self.post_digest = post_digest
+		self.attempts = attempts
+	
+	def __str__(self):
+		return f"Post edit {self.id}: {self.show_id}/{self.episode} ({self.post_url})"
+
 class EpisodeScore:
 	def __init__(self, show_id, episode, site_id, score):
 		self.show_id = show_id
@@ -101,7 +134,7 @@ class Stream(DbEqMixin):
 			If a show should be displayed with higher numbering (ex. continuing after a split cour), display_offset should be positive.
 			If a show should be numbered lower than 1 (ex. 0), display_offset should be negative.
 	"""
-	def __init__(self, id, service, show, show_id, show_key, name, remote_offset, display_offset, active):
+	def __init__(self, id, service, show, show_id, show_key, name, remote_offset, display_offset, active, last_checked=None):
 		# Note: arguments are order-sensitive
 		self.id = id
 		self.service = service
@@ -112,6 +145,7 @@ class Stream(DbEqMixin):
 		self.remote_offset = remote_offset
 		self.display_offset = display_offset
 		self.active = active
+		self.last_checked = last_checked		# Timestamp of the last request for new episodes
 	
 	def __str__(self):
 		return "Stream: {} ({}@{}), {} {}".format(self.show, self.show_key, self.service, self.remote_offset, self.display_offset)
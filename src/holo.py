@@ -22,10 +22,17 @@ def main(config, args, extra_args):
 	from logging import debug, info, warning, error, exception
 
 	# Set things up
-	db = database.living_in(config.database)
+	db = database.living_in(config.database,
+							journal_mode=config.db_journal_mode, synchronous=config.db_synchronous,
+							mmap_size=config.db_mmap_size, cache_size=config.db_cache_size,
+							busy_timeout=config.db_busy_timeout, statement_cache=config.db_statement_cache)
 	if not db:
 		error("Cannot continue running without a database")
 		return
+	if config.module != "setup" and db.get_schema_version() < database.SCHEMA_VERSION:
+		error("Database schema is out of date, run the setup module to migrate it")
+		db.close()
+		return
 
 	services.setup_services(config)
 
@@ -63,6 +70,14 @@ def main(config, args, extra_args):
 			info("Creating new thread")
 			import module_create_threads as m
 			m.main(config, db, *extra_args)
+		elif config.module == "edits":
+			info("Applying queued post edits")
+			import module_post_edits as m
+			m.main(config, db)
+		elif config.module == "daemon":
+			info("Running as a daemon")
+			import module_daemon as m
+			m.main(config, db)
 		elif config.module == "batch":
 			info("Batch creating threads")
 			import module_batch_create as m
@@ -73,6 +88,7 @@ def main(config, args, extra_args):
 		exception("Unknown exception or error")
 		db.rollback()
 
+	services.close_services()
 	db.close()
 
 if __name__ == "__main__":
@@ -80,7 +96,7 @@ if __name__ == "__main__":
 	import argparse
 	parser = argparse.ArgumentParser(description="{}, {}".format(name, description))
 	parser.add_argument("--no-input", dest="no_input", action="store_true", help="run without stdin and write to a log file")
-	parser.add_argument("-m", "--module", dest="module", nargs=1, choices=["setup", "edit", "episode", "update", "find", "create", "batch"], default=["episode"], help="runs the specified module")
+	parser.add_argument("-m", "--module", dest="module", nargs=1, choices=["setup", "edit", "episode", "update", "find", "create", "batch", "edits", "daemon"], default=["episode"], help="runs the specified module")
 	parser.add_argument("-c", "--config", dest="config_file", nargs=1, default=["config.ini"], help="use or create the specified database location")
 	parser.add_argument("-d", "--database", dest="db_name", nargs=1, default=None, help="use or create the specified database location")
 	parser.add_argument("-s", "--subreddit", dest="subreddit", nargs=1, default=None, help="set the subreddit on which to make posts")
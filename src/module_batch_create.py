@@ -5,7 +5,7 @@ import services
 from data.models import Stream, Episode
 import reddit
 
-from module_find_episodes import _create_reddit_post, _edit_reddit_post, _format_post_text
+from module_find_episodes import _create_reddit_post, _edit_reddit_post, _drain_post_edits, _format_post_text
 
 def main(config, db, show_name, episode_count):
 	int_episode_count = int(episode_count)
@@ -19,17 +19,18 @@ def main(config, db, show_name, episode_count):
 	post_urls = list()
 	for i in range(1, int_episode_count+1):
 		int_episode = Episode(i, None, None, None)
-		post_url = _create_reddit_post(config, db, show, stream, int_episode, submit=not config.debug)
+		post_url, post_digest = _create_reddit_post(config, db, show, stream, int_episode, submit=not config.debug)
 		info("  Post URL: {}".format(post_url))
 		if post_url is not None:
 			post_url = post_url.replace("http:", "https:")
-			db.add_episode(show, int_episode.number, post_url)
+			db.add_episode(show, int_episode.number, post_url, post_digest)
 		else:
 			error("  Episode not submitted")
 		post_urls.append(post_url)
 
 	for editing_episode in db.get_episodes(show):
 		_edit_reddit_post(config, db, show, stream, editing_episode, editing_episode.link, submit=not config.debug)
+	_drain_post_edits(config, db)
 
 	megathread_title, megathread_body = _create_megathread_content(config, db, show, stream, episode_count)
 
@@ -0,0 +1,58 @@
+from logging import debug, info, warning, error, exception
+from threading import Event
+from time import monotonic
+import signal
+
+import services
+import module_find_episodes
+import module_update_shows
+
+class _Job:
+	def __init__(self, name, interval, run):
+		self.name = name
+		self.interval = interval
+		self.run = run
+		self.next_run = 0
+
+def main(config, db):
+	stop = Event()
+	def request_stop(signum, frame):
+		info("Received signal {}, stopping after the current job".format(signum))
+		stop.set()
+	previous_handlers = {sig: signal.signal(sig, request_stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+
+	jobs = [
+		_Job("episode", config.daemon_episode_interval, lambda: module_find_episodes.main(config, db, debug=config.debug)),
+		_Job("update", config.daemon_update_interval, lambda: module_update_shows.main(config, db, poll_scores=False)),
+		_Job("poll score", config.daemon_poll_score_interval, lambda: module_update_shows.record_poll_scores(config, db, update_db=not config.debug)),
+	]
+	info("Scheduling jobs: {}".format(", ".join("{} every {}s".format(job.name, job.interval) for job in jobs)))
+
+	try:
+		# Jobs run one at a time on this thread, so they never overlap
+		while not stop.is_set():
+			job = min(jobs, key=lambda j: j.next_run)
+			wait = job.next_run - monotonic()
+			if wait > 0 and stop.wait(wait):
+				break
+
+			started = monotonic()
+			_run_job(db, job)
+			# A job running late is run once when due, missed runs aren't caught up
+			job.next_run = started + job.interval
+			debug("Job {} took {:.1f}s".format(job.name, monotonic() - started))
+	finally:
+		for sig, handler in previous_handlers.items():
+			signal.signal(sig, handler)
+	info("Daemon stopped")
+
+def _run_job(db, job):
+	info("Running {} job".format(job.name))
+	# Responses and rows kept by the previous job may be outdated
+	services.reset_request_memo()
+	db.clear_cache()
+	try:
+		job.run()
+	except:
+		exception("Failed to run {} job".format(job.name))
+		db.rollback()
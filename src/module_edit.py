@@ -1,16 +1,22 @@
 from logging import debug, info, warning, error, exception
+import sqlite3
 
 import services
 from data.models import UnprocessedShow, UnprocessedStream, ShowType, str_to_showtype
 
+class _EditFailed(Exception):
+	pass
+
 def main(config, db, *args, **kwargs):
 	if len(args) == 1:
-		if _edit_with_file(db, args[0]):
-			info("Edit successful; saving")
-			db.commit()
-		else:
-			error("Edit failed; reverting")
-			db.rollback()
+		# The whole file is saved in a single commit, or reverted if any show fails
+		try:
+			with db.transaction():
+				if not _edit_with_file(db, args[0]):
+					raise _EditFailed()
+				info("Edit successful; saving")
+		except (_EditFailed, sqlite3.Error):
+			error("Edit failed; reverted")
 	else:
 		warning("Nothing to do")
 
@@ -111,7 +117,7 @@ def _edit_with_file(db, edit_file):
 				elif "|" in service_key:
 					# Lite stream
 					service, service_name = service_key.split("|", maxsplit=1)
-					db.add_lite_stream(show_id, service, service_name, url)
+					db.add_lite_stream(show_id, service, service_name, url, commit=False)
 				else:
 					error("    Stream handler not installed")
 
@@ -120,7 +126,7 @@ def _edit_with_file(db, edit_file):
 			aliases = doc["alias"]
 			for alias in aliases:
 				if alias != '':
-					db.add_alias(show_id, alias)
+					db.add_alias(show_id, alias, commit=False)
 			info(f"Added {len(aliases)} alias{'es' if len(aliases) > 1 else ''}")
 			
 	return True
@@ -1,30 +1,71 @@
-from logging import debug, info, warning, error
-from datetime import date, timedelta
+from logging import debug, info, warning, error, exception
+from datetime import date, datetime, timedelta
+import time, sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 
 import services
-from data.models import Stream
+from data.models import Stream, Episode
 import reddit
+import templates
 
 def main(config, db, **kwargs):
 	reddit.init_reddit(config)
+	_discussion_tables.clear()
 	
 	has_new_episode = []
 	
 	# Check services for new episodes
 	enabled_services = db.get_services(enabled=True)
 
-	for service in enabled_services:
-		try:
-			service_handler = services.get_service_handler(service)
+	# Note : selecting only shows with missing streams avoids troll torrents,
+	# but also can cause delays if supported services are later than unsupported ones
+	#other_shows = set(db.get_shows(missing_stream=True)) | set(db.get_shows(delayed=True))
+	other_shows = set(db.get_shows(missing_stream=False)) | set(db.get_shows(delayed=True))
+	other_streams = [Stream.from_show(show) for show in other_shows]
 
-			streams = db.get_streams(service=service)
-			debug("{} streams found".format(len(streams)))
+	# Latest posted episode of every show, updated as new episodes are posted
+	latest_episodes = db.get_latest_episodes()
+	if latest_episodes is None:
+		error("Failed to load latest episodes")
+		return
+
+	# Streams outside their show's usual release window are checked less often
+	release_times = db.get_release_times() if config.adaptive_polling else None
+	checked_streams = list()
+	now = datetime.utcnow()
+
+	# Fetch every stream concurrently, then process results in order on this thread
+	# so database writes and reddit submissions keep the same order as a serial run
+	with ThreadPoolExecutor(max_workers=config.fetch_workers) as pool:
+		fetches = list()
+		for service in enabled_services:
+			service_handler = services.get_service_handler(service)
+			if not service_handler.is_generic:
+				streams = db.get_streams(service=service)
+				debug("{} streams found".format(len(streams)))
+				if release_times is not None:
+					streams = [stream for stream in streams if _is_stream_due(config, stream, release_times, now)]
+					debug("{} streams due".format(len(streams)))
+				fetches.append((service, False, _submit_fetches(pool, config, service_handler, streams, latest_episodes)))
+
+		if len(other_shows) > 0:
+			info("Checking generic services for {} shows".format(len(other_shows)))
+		for service in enabled_services:
+			service_handler = services.get_service_handler(service)
+			if service_handler.is_generic:
+				debug("    Checking service {}".format(service_handler.name))
+				fetches.append((service, True, _submit_fetches(pool, config, service_handler, other_streams)))
 
-			recent_episodes = service_handler.get_recent_episodes(streams, useragent=config.useragent)
-			info(f"{len(recent_episodes)} episodes for active shows on service {service}")
+		for service, is_generic, futures in fetches:
+			recent_episodes = _collect_fetches(service, futures)
+			info(f"{len(recent_episodes)} episodes for active shows on {'generic ' if is_generic else ''}service {service}")
+			# Streams whose fetch failed are retried next run instead of waiting an idle interval
+			if release_times is not None and not is_generic:
+				checked_streams.extend(stream for stream, episodes in recent_episodes.items() if episodes is not None)
 
 			for stream, episodes in recent_episodes.items():
-				show = db.get_show(stream=stream)
+				show = stream.show		# Loaded with the streams
 				if show is None or not show.enabled:
 					continue
 
@@ -32,49 +73,17 @@ def main(config, db, **kwargs):
 				debug(stream)
 
 				if not episodes:
-					info("  Show/episode not found")
+					info("  No episode found" if is_generic else "  Show/episode not found")
 					continue
 
 				for episode in sorted(episodes, key=lambda e: e.number):
-					if _process_new_episode(config, db, show, stream, episode):
+					if _process_new_episode(config, db, show, stream, episode, latest_episodes):
 						has_new_episode.append(show)
-		except IOError:
-			error(f'Error while getting shows on service {service}')
-
-	# Check generic services
-	# Note : selecting only shows with missing streams avoids troll torrents,
-	# but also can cause delays if supported services are later than unsupported ones
-	#other_shows = set(db.get_shows(missing_stream=True)) | set(db.get_shows(delayed=True))
-	other_shows = set(db.get_shows(missing_stream=False)) | set(db.get_shows(delayed=True))
-	if len(other_shows) > 0:
-		info("Checking generic services for {} shows".format(len(other_shows)))
-
-	other_streams = [Stream.from_show(show) for show in other_shows]
-	for service in enabled_services:
-		try:
-			service_handler = services.get_service_handler(service)
-			if service_handler.is_generic:
-				debug("    Checking service {}".format(service_handler.name))
-				recent_episodes = service_handler.get_recent_episodes(other_streams, useragent=config.useragent)
-				info(f"{len(recent_episodes)} episodes for active shows on generic service {service}")
-
-				for stream, episodes in recent_episodes.items():
-					show = db.get_show(stream=stream)
-					if show is None or not show.enabled:
-						continue
 
-					info("Checking stream \"{}\"".format(stream.show_key))
-					debug(stream)
+	if not config.debug:
+		db.set_streams_checked(checked_streams, int(time.time()))
 
-					if not episodes:
-						info("  No episode found")
-						continue
-
-					for episode in sorted(episodes, key=lambda e: e.number):
-						if _process_new_episode(config, db, show, stream, episode):
-							has_new_episode.append(show)
-		except IOError:
-			error(f'Error while getting shows on service {service}')
+	_drain_post_edits(config, db)
 
 	debug("")
 	debug("Summary of shows with new episodes:")
@@ -82,9 +91,66 @@ def main(config, db, **kwargs):
 		debug("  {}".format(show.name))
 	debug("")
 
+def _submit_fetches(pool, config, service_handler, streams, latest_episodes=None):
+	"""
+	Schedules the requests for recent episodes of a service's streams.
+	Handlers fetching all streams at once get a single job, others get one job per stream.
+	:param latest_episodes: Latest posted episodes, given to handlers using them
+	:return: A list of futures, each resulting in a dict of streams to episodes
+	"""
+	if service_handler.bulk_recent_episodes:
+		return [pool.submit(service_handler.get_recent_episodes, streams, useragent=config.useragent)]
+	futures = list()
+	for stream in streams:
+		kwargs = dict()
+		if service_handler.uses_latest_episode and latest_episodes is not None and stream.show is not None:
+			kwargs["latest_episode"] = latest_episodes.get(stream.show)
+		futures.append(pool.submit(_fetch_stream_episodes, service_handler, stream, config.useragent, **kwargs))
+	return futures
+
+def _fetch_stream_episodes(service_handler, stream, useragent, **kwargs):
+	return {stream: service_handler.get_all_episodes(stream, useragent=useragent, **kwargs)}
+
+def _collect_fetches(service, futures):
+	recent_episodes = dict()
+	for future in futures:
+		try:
+			recent_episodes.update(future.result())
+		except IOError:
+			error(f'Error while getting shows on service {service}')
+		except Exception:
+			# A failing handler mustn't stop the other services from being checked
+			exception(f'Unexpected error while getting shows on service {service}')
+	return recent_episodes
+
+def _is_stream_due(config, stream, release_times, now):
+	"""
+	Checks if a stream should be requested this run: always while its show is delayed,
+	has no known release time or is inside its release window, otherwise once per idle interval.
+	"""
+	show = stream.show
+	if show is None or show.delayed or show.id not in release_times:
+		return True
+	if _in_release_window(config, release_times[show.id], now):
+		return True
+	return stream.last_checked is None or time.time() - stream.last_checked >= config.idle_poll_interval
+
+def _in_release_window(config, release_times, now):
+	# Times other than the usual ones (ex. a single early release) are ignored
+	usual_count = max(count for _, _, count in release_times)
+	week_hours = 7 * 24
+	now_hour = now.weekday() * 24 + now.hour + now.minute / 60
+	for weekday, hour, count in release_times:
+		if 2 * count < usual_count:
+			continue
+		hours_after = (now_hour - (weekday * 24 + hour)) % week_hours
+		if hours_after <= config.release_window_after or hours_after >= week_hours - config.release_window_before:
+			return True
+	return False
+
 #yesterday = date.today() - timedelta(days=1)
 
-def _process_new_episode(config, db, show, stream, episode):
+def _process_new_episode(config, db, show, stream, episode, latest_episodes=None):
 	debug("Processing new episode")
 	debug(episode)
 	
@@ -101,7 +167,7 @@ def _process_new_episode(config, db, show, stream, episode):
 		
 		# Check if already in database
 		#already_seen = db.stream_has_episode(stream, episode.number)
-		latest_episode = db.get_latest_episode(show)
+		latest_episode = latest_episodes.get(show) if latest_episodes is not None else db.get_latest_episode(show)
 		already_seen = latest_episode is not None and latest_episode.number >= int_episode.number
 		episode_number_gap = latest_episode is not None and latest_episode.number > 0 and int_episode.number > latest_episode.number + 1
 		debug("  Latest ep num: {}".format("none" if latest_episode is None else latest_episode.number))
@@ -115,13 +181,27 @@ def _process_new_episode(config, db, show, stream, episode):
 		
 		# New episode!
 		if not already_seen and not episode_number_gap:
-			post_url = _create_reddit_post(config, db, show, stream, int_episode, submit=not config.debug)
+			post_url, post_digest = _create_reddit_post(config, db, show, stream, int_episode, submit=not config.debug)
 			info("  Post URL: {}".format(post_url))
 			if post_url is not None:
 				post_url = post_url.replace("http:", "https:")
-				db.add_episode(stream.show, int_episode.number, post_url)
-				if show.delayed:
-					db.set_show_delayed(show, False)
+				# Updated first so later streams of the run never post the episode again, even if recording it fails
+				if latest_episodes is not None:
+					latest_episodes.update(show, Episode(int_episode.number, None, post_url, None))
+				# Committed right away, the post must never be submitted twice
+				try:
+					with db.transaction():
+						db.add_episode(stream.show, int_episode.number, post_url, post_digest)
+						if show.delayed:
+							db.set_show_delayed(show, False)
+						else:
+							# Late releases of delayed shows would skew their usual release time.
+							# Learned from when the episode was found, since dates of some services
+							# only have a day or aren't in UTC
+							db.add_release_time(show, datetime.utcnow())
+				except sqlite3.Error:
+					exception("  Failed to record episode posted at {}, rolled back".format(post_url))
+					return True
 				# Edit the links in previous episodes
 				editing_episodes = db.get_episodes(show)
 				if len(editing_episodes) > 0:
@@ -139,6 +219,10 @@ def _process_new_episode(config, db, show, stream, episode):
 	return False
 
 def _create_reddit_post(config, db, show, stream, episode, submit=True):
+	"""
+	Submits the post of an episode.
+	:return: The post URL and the digest of its body, the URL is None if nothing was submitted
+	"""
 	display_episode = stream.to_display_episode(episode)
 	
 	title, body = _create_post_contents(config, db, show, stream, display_episode)
@@ -146,19 +230,72 @@ def _create_reddit_post(config, db, show, stream, episode, submit=True):
 		new_post = reddit.submit_text_post(config.subreddit, title, body)
 		if new_post is not None:
 			debug("Post successful")
-			return reddit.get_longlink_from_id(config.subreddit, new_post.id)
+			return reddit.get_longlink_from_id(config.subreddit, new_post.id), _post_digest(body)
 		else:
 			error("Failed to submit post")
-	return None
+	return None, None
 
 def _edit_reddit_post(config, db, show, stream, episode, url, submit=True):
 	display_episode = stream.to_display_episode(episode)
 	
 	_, body = _create_post_contents(config, db, show, stream, display_episode, quiet=True)
+	# Posts are only edited when their body changed since it was last sent
+	post_digest = _post_digest(body)
+	if post_digest == db.get_post_digest(show, episode):
+		debug("Post {} unchanged, not editing".format(url))
+		if submit:
+			db.cancel_post_edit(url)		# A queued body would be older than the current one
+		return None
 	if submit:
-		reddit.edit_text_post(url, body)
+		db.queue_post_edit(show, episode, url, body, post_digest)
 	return None
 
+_MAX_EDIT_ATTEMPTS = 3
+
+def _drain_post_edits(config, db):
+	"""
+	Applies the queued post edits, oldest first, as fast as reddit's rate limit allows.
+	An edit leaves the queue only once applied, so edits interrupted by a crash are applied by the next run.
+	"""
+	if config.debug:
+		return
+	edits = db.get_post_edits()
+	if len(edits) == 0:
+		return
+	info("Applying {} queued post edits".format(len(edits)))
+	
+	# Checked together so edits of archived posts are dropped without trying them
+	posts = reddit.get_text_posts([edit.post_url for edit in edits])
+	for n, edit in enumerate(edits):
+		if edit.attempts >= _MAX_EDIT_ATTEMPTS:
+			warning("Dropping edit of post {} after {} failed attempts".format(edit.post_url, edit.attempts))
+			db.remove_post_edit(edit)
+			continue
+		post = posts.get(edit.post_url)
+		if post is not None and post.archived:
+			info("Dropping edit of archived post {}".format(edit.post_url))
+			db.remove_post_edit(edit)
+			continue
+		if not reddit.wait_for_rate_limit():
+			warning("Reddit rate limit reached, {} edits left queued".format(len(edits) - n))
+			break
+		
+		# Another run may have queued a newer body, which replaces the row, or applied this one
+		current = db.get_post_edit(edit.id)
+		if current is None or current.body != edit.body:
+			debug("Edit of post {} changed since it was read, skipping".format(edit.post_url))
+			continue
+		if reddit.edit_text_post(edit.post_url, edit.body) is not None:
+			show = db.get_show(id=edit.show_id)
+			with db.transaction():
+				db.set_post_digest(show, Episode(edit.episode, None, edit.post_url, None), edit.post_digest)
+				db.remove_post_edit(edit)
+		else:
+			db.add_post_edit_attempt(edit)
+
+def _post_digest(body):
+	return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
 def _create_post_contents(config, db, show, stream, episode, quiet=False):
 	title = _create_post_title(config, show, episode)
 	title = _format_post_text(config, db, title, config.post_formats, show, episode, stream)
@@ -168,24 +305,23 @@ def _create_post_contents(config, db, show, stream, episode, quiet=False):
 	return title, body
 
 def _format_post_text(config, db, text, formats, show, episode, stream):
-	#TODO: change to a more block-based system (can exclude blocks without content)
-	if "{spoiler}" in text:
-		text = safe_format(text, spoiler=_gen_text_spoiler(formats, show))
-	if "{streams}" in text:
-		text = safe_format(text, streams=_gen_text_streams(db, formats, show))
-	if "{links}" in text:
-		text = safe_format(text, links=_gen_text_links(db, formats, show))
-	if "{discussions}" in text:
-		text = safe_format(text, discussions=_gen_text_discussions(db, formats, show, stream))
-	if "{aliases}" in text:
-		text = safe_format(text, aliases=_gen_text_aliases(db, formats, show))
-	if "{poll}" in text:
-		text = safe_format(text, poll=_gen_text_poll(db, config, formats, show, episode))
+	template = templates.compile_template(text)
 	
-	episode_name = ": {}".format(episode.name) if episode.name else ""
-	episode_alt_number = "" if stream.remote_offset == 0 else f" ({episode.number + stream.remote_offset})"
-	text = safe_format(text, show_name=show.name, show_name_en=show.name_en, episode=episode.number, episode_alt_number=episode_alt_number, episode_name=episode_name)
-	return text.strip()
+	# Only the parts used by the template are generated, in this order since the poll part may create a poll
+	generators = [
+		("spoiler", lambda: _gen_text_spoiler(formats, show)),
+		("streams", lambda: _gen_text_streams(db, formats, show)),
+		("links", lambda: _gen_text_links(db, formats, show)),
+		("discussions", lambda: _gen_text_discussions(db, formats, show, stream)),
+		("aliases", lambda: _gen_text_aliases(db, formats, show)),
+		("poll", lambda: _gen_text_poll(db, config, formats, show, episode)),
+	]
+	values = {name: generate() for name, generate in generators if name in template.fields}
+	
+	values["episode_name"] = ": {}".format(episode.name) if episode.name else ""
+	values["episode_alt_number"] = "" if stream.remote_offset == 0 else f" ({episode.number + stream.remote_offset})"
+	values.update(show_name=show.name, show_name_en=show.name_en, episode=episode.number)
+	return template.render(values).strip()
 
 def _create_post_title(config, show, episode):
 	if show.name_en:
@@ -247,7 +383,21 @@ def _gen_text_links(db, formats, show):
 
 	return "\n".join(link_texts) + '\n' + '\n'.join(link_texts_bottom)
 
+# (show id, display offset) -> (show revision, table text), reused by every post of a show during a run
+_discussion_tables = dict()
+
 def _gen_text_discussions(db, formats, show, stream):
+	key = (show.id, stream.display_offset)
+	revision = db.get_show_revision(show)
+	cached = _discussion_tables.get(key)
+	if cached is not None and cached[0] == revision:
+		debug("Reusing discussion table for show {}".format(show))
+		return cached[1]
+	text = _build_discussion_table(db, formats, show, stream)
+	_discussion_tables[key] = (revision, text)
+	return text
+
+def _build_discussion_table(db, formats, show, stream):
 	episodes = db.get_episodes(show)
 	debug("Num previous episodes: {}".format(len(episodes)))
 	N_LINES = 13
@@ -256,19 +406,23 @@ def _gen_text_discussions(db, formats, show, stream):
 		debug(f'Clipping to most recent {n_episodes} episodes')
 		episodes = episodes[-n_episodes:]
 	if len(episodes) > 0:
+		# All polls of the show in one query, unscored ones are requested together
+		poll_handler = services.get_default_poll_handler()
+		polls = dict()
+		for poll in db.get_polls(show=show):
+			polls.setdefault(poll.episode, poll)
+		episodes = [stream.to_display_episode(episode) for episode in episodes]
+		episode_polls = [polls[episode.number] for episode in episodes if episode.number in polls]
+		scores = poll_handler.get_scores(episode_polls)
+		
 		table = []
 		for episode in episodes:
-			episode = stream.to_display_episode(episode)
-			poll_handler = services.get_default_poll_handler()
-			poll = db.get_poll(show, episode)
+			poll = polls.get(episode.number)
 			if poll is None:
 				score = None
 				poll_link = None
-			elif poll.has_score:
-				score = poll.score
-				poll_link = poll_handler.get_results_link(poll)
 			else:
-				score = poll_handler.get_score(poll)
+				score = scores.get(poll.id)
 				poll_link = poll_handler.get_results_link(poll)
 			score = poll_handler.convert_score_str(score)
 			table.append(safe_format(formats["discussion"], episode=episode.number, link=episode.link, score=score, poll_link=poll_link if poll_link else "http://localhost")) # Need valid link even when empty
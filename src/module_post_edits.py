@@ -0,0 +1,9 @@
+from logging import debug, info, warning, error
+
+import reddit
+
+from module_find_episodes import _drain_post_edits
+
+def main(config, db):
+	reddit.init_reddit(config)
+	_drain_post_edits(config, db)
@@ -3,14 +3,15 @@ from datetime import datetime, timedelta
 
 import services
 
-def main(config, db, **kwargs):
+def main(config, db, poll_scores=True, **kwargs):
 	# Find data not provided by the edit module
 	_check_missing_stream_info(config, db, update_db=not config.debug)
 	# Check for new show scores
 	if config.record_scores:
 		_check_new_episode_scores(config, db, update_db=not config.debug)
 	# Record poll scores to avoid querying them every time
-	_record_poll_scores(config, db, update_db=not config.debug)
+	if poll_scores:
+		record_poll_scores(config, db, update_db=not config.debug)
 	# Show lengths aren't always known at the start of the season
 	_check_show_lengths(config, db, update_db=not config.debug)
 	# Check if shows have finished and disable them if they have
@@ -20,6 +21,7 @@ def _check_show_lengths(config, db, update_db=True):
 	info("Checking show lengths")
 	
 	shows = db.get_shows(missing_length=True)
+	new_lengths = list()
 	for show in shows:
 		info("Updating episode count of {} ({})".format(show.name, show.id))
 		length = None
@@ -48,29 +50,38 @@ def _check_show_lengths(config, db, update_db=True):
 		if length is not None:
 			info("New episode count: {}".format(length))
 			if update_db:
-				db.set_show_episode_count(show, length)
+				new_lengths.append((show, length))
 			else:
 				warning("Debug enabled, not updating database")
+	
+	# Written together once all sites have been checked
+	with db.transaction():
+		for show, length in new_lengths:
+			db.set_show_episode_count(show, length)
 
 def _disable_finished_shows(config, db, update_db=True):
 	info("Checking for disabled shows")
 	
 	shows = db.get_shows()
-	for show in shows:
-		latest_episode = db.get_latest_episode(show)
-		if latest_episode is not None and 0 < show.length <= latest_episode.number:
-			info("  Disabling show \"{}\"".format(show.name))
-			if latest_episode.number > show.length:
-				warning("    Episode number ({}) greater than show length ({})".format(latest_episode.number, show.length))
-			if update_db:
-				db.set_show_enabled(show, enabled=False, commit=False)
-	if update_db:
-		db.save()
+	latest_episodes = db.get_latest_episodes()
+	if latest_episodes is None:
+		error("  Failed to load latest episodes")
+		return
+	with db.transaction():
+		for show in shows:
+			latest_episode = latest_episodes.get(show)
+			if latest_episode is not None and 0 < show.length <= latest_episode.number:
+				info("  Disabling show \"{}\"".format(show.name))
+				if latest_episode.number > show.length:
+					warning("    Episode number ({}) greater than show length ({})".format(latest_episode.number, show.length))
+				if update_db:
+					db.set_show_enabled(show, enabled=False)
 
 def _check_missing_stream_info(config, db, update_db=True):
 	info("Checking for missing stream info")
 	
 	streams = db.get_streams(missing_name=True)
+	updated_streams = list()
 	for stream in streams:
 		service_info = db.get_service(id=stream.service)
 		info("Updating missing stream info of {} ({}/{})".format(stream.name, service_info.name, stream.show_key))
@@ -85,23 +96,30 @@ def _check_missing_stream_info(config, db, update_db=True):
 		debug("  key={}".format(stream.show_key))
 		debug("  id={}".format(stream.show_id))
 		if update_db:
-			db.update_stream(stream, name=stream.name, show_id=stream.show_id, show_key=stream.show_key, commit=False)
+			updated_streams.append(stream)
 	
-	if update_db:
-		db.commit()
+	# Written together once all services have been requested
+	with db.transaction():
+		for stream in updated_streams:
+			db.update_stream(stream, name=stream.name, show_id=stream.show_id, show_key=stream.show_key)
 
 def _check_new_episode_scores(config, db, update_db):
 	info("Checking for new episode scores")
 	
 	shows = db.get_shows(enabled=True)
+	latest_episodes = db.get_latest_episodes()
+	if latest_episodes is None:
+		error("  Failed to load latest episodes")
+		return
 	for show in shows:
-		latest_episode = db.get_latest_episode(show)
+		latest_episode = latest_episodes.get(show)
 		if latest_episode is not None:
 			info("For show {} ({}), episode {}".format(show.name, show.id, latest_episode .number))
 			
 			scores = db.get_episode_scores(show, latest_episode)
 			# Check if any scores have been found rather than checking for each service
 			if len(scores) == 0:
+				new_scores = list()
 				for handler in services.get_link_handlers().values():
 					info("  Checking {} ({})".format(handler.name, handler.key))
 					
@@ -115,25 +133,40 @@ def _check_new_episode_scores(config, db, update_db):
 					new_score = handler.get_show_score(show, link, useragent=config.useragent)
 					if new_score is not None:
 						info("    Score: {}".format(new_score))
-						db.add_episode_score(show, latest_episode, site, new_score, commit=False)
+						new_scores.append((site, new_score))
 				
+				# One commit per show once all sites have been checked
 				if update_db:
-					db.commit()
+					with db.transaction():
+						for site, new_score in new_scores:
+							db.add_episode_score(show, latest_episode, site, new_score)
 			else:
 				info("  Already has scores, ignoring")
 
-def _record_poll_scores(config, db, update_db):
+def record_poll_scores(config, db, update_db=True):
+	"""
+	Records the scores of polls old enough to be final, also run on its own schedule by the daemon.
+	:param update_db: If False, scores are only logged
+	"""
 	polls = db.get_polls(missing_score=True)
 	handler = services.get_default_poll_handler()
 	info(f"Record scores for service {handler.key}")
 
-	updated = 0
-	for poll in polls:
-		if timedelta(days=8) < datetime.now() - poll.date < timedelta(days=93) :
-			score = handler.get_score(poll)
-			info(f"Updating poll score for show {poll.show_id} / episode {poll.episode} ({score})")
-			if score:
-				db.update_poll_score(poll, score, commit=update_db)
-				updated += 1
+	now = datetime.now()
+	polls_to_score = [poll for poll in polls if timedelta(days=8) < now - poll.date < timedelta(days=93)]
+	scores = handler.get_scores(polls_to_score)
+
+	new_scores = list()
+	for poll in polls_to_score:
+		score = scores.get(poll.id)
+		info(f"Updating poll score for show {poll.show_id} / episode {poll.episode} ({score})")
+		if score:
+			new_scores.append((poll, score))
+	updated = len(new_scores)
+
+	if update_db:
+		with db.transaction():
+			for poll, score in new_scores:
+				db.update_poll_score(poll, score)
 
 	info(f"{updated} scores recorded, {len(polls) - updated} scores not updated")
@@ -1,4 +1,6 @@
 from logging import debug, info, warning, error, exception
+from time import time, sleep, monotonic
+import re
 import praw
 
 # Initialization
@@ -6,6 +8,10 @@ import praw
 _r = None
 _config = None
 
+_flair_ttl = 3600
+_flair_templates = dict()		# subreddit -> (fetch time, selectable flair template IDs)
+_post_id_re = re.compile(r"/comments/(\w+)")
+
 def init_reddit(config):
 	global _config
 	_config = config
@@ -31,14 +37,14 @@ def _ensure_connection():
 def submit_text_post(subreddit, title, body):
 	_ensure_connection()
 	try:
-		info("Checking availability of flair {_config.post_flair_id}")
-		flair_ids = [ft['flair_template_id'] for ft in _r.subreddit(subreddit).flair.link_templates.user_selectable()]
-		if _config.post_flair_id in flair_ids:
-			flair_id, flair_text = _config.post_flair_id, _config.post_flair_text
-		else:
-			warning('Flair not selectable, flairing will be disabled')
-			flair_id, flair_text = None, None
-                        
+		flair_id, flair_text = None, None
+		if _config.post_flair_id:
+			info(f"Checking availability of flair {_config.post_flair_id}")
+			if _config.post_flair_id in _get_flair_ids(subreddit):
+				flair_id, flair_text = _config.post_flair_id, _config.post_flair_text
+			else:
+				warning('Flair not selectable, flairing will be disabled')
+		
 		info("Submitting post to {}".format(subreddit))
 		new_post = _r.subreddit(subreddit).submit(title,
 		                                          selftext=body,
@@ -61,15 +67,74 @@ def edit_text_post(url, body):
 		exception("Failed to submit text post")
 		return None
 
+def wait_for_rate_limit(reserve=10, max_wait=60):
+	"""
+	Waits until reddit's rate limit allows more requests, keeping a few requests for other calls.
+	:param reserve: Number of requests left unused in the current rate limit window
+	:param max_wait: Maximum number of seconds to wait for the window to reset
+	:return: True if requests can be made, False if the limit doesn't reset soon enough
+	"""
+	if not _ensure_connection():
+		return False
+	limits = _r.auth.limits
+	remaining, reset_timestamp = limits.get("remaining"), limits.get("reset_timestamp")
+	if remaining is None or remaining > reserve:
+		return True
+	wait = reset_timestamp - time() if reset_timestamp is not None else 0
+	if wait > max_wait:
+		return False
+	if wait > 0:
+		info("Waiting {:.0f} seconds for the reddit rate limit".format(wait))
+		sleep(wait)
+	return True
+
 def get_text_post(url):
+	"""
+	Gets a handle on a post from its URL. Nothing is requested until the post data is used.
+	"""
 	_ensure_connection()
 	try:
-		new_post = _r.submission(url=url)
-		return new_post
+		post_id = _get_post_id(url)
+		if post_id is not None:
+			return _r.submission(id=post_id)
+		return _r.submission(url=url)
 	except:
 		exception("Failed to retrieve text post")
 		return None
 
+def get_text_posts(urls):
+	"""
+	Fetches many posts with batched info requests of up to 100 posts.
+	:param urls: The post URLs
+	:return: A dict of URLs to fetched posts, posts that couldn't be found are missing
+	"""
+	_ensure_connection()
+	ids = {_get_post_id(url): url for url in urls}
+	ids.pop(None, None)
+	if len(ids) == 0:
+		return dict()
+	try:
+		posts = _r.info(fullnames=["t3_" + post_id for post_id in ids])
+		return {ids[post.id]: post for post in posts if post.id in ids}
+	except:
+		exception("Failed to retrieve text posts")
+		return dict()
+
+def _get_post_id(url):
+	match = _post_id_re.search(url)
+	return match.group(1) if match else None
+
+def _get_flair_ids(subreddit):
+	"""
+	Gets the user selectable flair templates of a subreddit, requested at most once per TTL.
+	"""
+	cached = _flair_templates.get(subreddit)
+	if cached is not None and monotonic() - cached[0] < _flair_ttl:
+		return cached[1]
+	flair_ids = {ft['flair_template_id'] for ft in _r.subreddit(subreddit).flair.link_templates.user_selectable()}
+	_flair_templates[subreddit] = (monotonic(), flair_ids)
+	return flair_ids
+
 #NOTE: PRAW3 stuff
 #def send_modmail(subreddit, title, body):
 #	_ensure_connection()
@@ -1,15 +1,41 @@
 from logging import debug, warning, error
 from abc import abstractmethod, ABC
 from types import ModuleType
+import os
 from typing import List, Dict, Optional, Iterable
 
 # Common
 
 _service_configs = None
+_pool_connections = 10
+_pool_maxsize = 10
+_default_rate_limit = 1.0
+_host_connections = 2
+_fetch_workers = 8
+_cache_dir = "cache"
+_http_cache = None
 
 def setup_services(config):
-	global _service_configs
+	global _service_configs, _pool_connections, _pool_maxsize, _default_rate_limit, _host_connections, _fetch_workers, _cache_dir, _http_cache
 	_service_configs = config.services
+	_default_rate_limit = config.ratelimit
+	_host_connections = config.host_connections
+	_fetch_workers = config.fetch_workers
+	_cache_dir = config.cache_dir
+	_http_cache = get_disk_cache("http") if config.http_cache else None
+	if _http_cache is not None:
+		_http_cache.prune(max_age=config.http_cache_max_age * 86400, max_entries=config.http_cache_max_entries)
+	reset_request_memo()
+	_pool_connections = config.pool_connections
+	_pool_maxsize = config.pool_maxsize
+
+def close_services():
+	"""
+	Closes the pooled HTTP sessions of every loaded handler.
+	"""
+	for handlers in (_services, _link_sites, _poll_sites):
+		for handler in handlers.values():
+			handler.close()
 
 def _get_service_config(key):
 	if key in _service_configs:
@@ -22,6 +48,21 @@ def _make_service(service):
 
 # Utilities
 
+def get_disk_cache(namespace):
+	"""
+	Gets a persistent store kept in its own directory of the configured cache directory.
+	:param namespace: Name of the store, such as a service key
+	:return: A DiskCache
+	"""
+	from .cache import DiskCache
+	return DiskCache(os.path.join(_cache_dir, namespace))
+
+def get_fetch_workers():
+	"""
+	:return: The number of threads a handler may use to fetch streams concurrently
+	"""
+	return _fetch_workers
+
 def import_all_services(pkg: ModuleType, class_name: str):
 	import importlib
 	services = dict()
@@ -40,36 +81,239 @@ def import_all_services(pkg: ModuleType, class_name: str):
 # Requesting #
 ##############
 
-from functools import wraps, lru_cache
+from functools import lru_cache
 from time import perf_counter, sleep
+from threading import Lock, BoundedSemaphore, Event
+from urllib.parse import urlsplit
 import requests
-from json import JSONDecodeError
+from requests.adapters import HTTPAdapter
+from json import JSONDecodeError, loads as parse_json
 from xml.etree import ElementTree as xml_parser
 from bs4 import BeautifulSoup
 import feedparser
 
-def rate_limit(wait_length):
-	last_time = 0
+class TokenBucket:
+	"""
+	Rate limiter allowing short bursts of requests while keeping an average of one request per wait length.
+	Only the threads requesting the same host wait on a bucket; other hosts proceed independently.
+	"""
+	def __init__(self, wait_length, burst=1):
+		self.wait_length = wait_length
+		self.burst = burst
+		self._tokens = burst
+		self._last_time = perf_counter()
+		self._lock = Lock()
 	
-	def decorate(f):
-		@wraps(f)
-		def rate_limited(*args, **kwargs):
-			nonlocal last_time
-			diff = perf_counter() - last_time
-			if diff < wait_length:
-				sleep(wait_length - diff)
-			
-			r = f(*args, **kwargs)
-			last_time = perf_counter()
-			return r
-		return rate_limited
-	return decorate
+	def tighten(self, wait_length, burst):
+		"""
+		Applies the stricter of the current and given limits, used when several handlers share a host.
+		"""
+		with self._lock:
+			self.wait_length = max(self.wait_length, wait_length)
+			self.burst = min(self.burst, burst)
+			self._tokens = min(self._tokens, self.burst)
+	
+	def acquire(self):
+		"""
+		Takes a token from the bucket, sleeping the calling thread until one is available.
+		"""
+		with self._lock:
+			while True:
+				now = perf_counter()
+				if self.wait_length > 0:
+					self._tokens = min(self.burst, self._tokens + (now - self._last_time) / self.wait_length)
+				else:
+					self._tokens = self.burst
+				self._last_time = now
+				if self._tokens >= 1:
+					self._tokens -= 1
+					return
+				sleep((1 - self._tokens) * self.wait_length)
+
+_rate_limiters = dict()
+_rate_limiters_lock = Lock()
+
+def get_rate_limiter(host, wait_length, burst=1) -> TokenBucket:
+	"""
+	Gets the rate limiter of a host, creating it with the given limits if needed.
+	:param host: The host being requested
+	:param wait_length: Average number of seconds between requests
+	:param burst: Number of requests allowed back-to-back
+	:return: The host's token bucket
+	"""
+	with _rate_limiters_lock:
+		limiter = _rate_limiters.get(host)
+		if limiter is None:
+			debug("Rate limiting {} to one request every {}s (burst {})".format(host, wait_length, burst))
+			limiter = TokenBucket(wait_length, burst)
+			_rate_limiters[host] = limiter
+			return limiter
+	if wait_length > limiter.wait_length or burst < limiter.burst:
+		limiter.tighten(wait_length, burst)
+	return limiter
+
+_host_semaphores = dict()
+
+def _get_host_semaphore(host):
+	"""
+	Gets the semaphore capping the number of concurrent requests sent to a host.
+	"""
+	with _rate_limiters_lock:
+		semaphore = _host_semaphores.get(host)
+		if semaphore is None:
+			semaphore = BoundedSemaphore(_host_connections)
+			_host_semaphores[host] = semaphore
+	return semaphore
+
+# Responses already fetched and parsed during the current run, by URL and parse mode
+
+class _PendingRequest:
+	def __init__(self):
+		self.done = Event()
+		self.result = None
+
+_request_memo = dict()
+_request_pending = dict()
+_request_memo_lock = Lock()
+
+def reset_request_memo():
+	"""
+	Forgets the responses memoized during the current run.
+	"""
+	with _request_memo_lock:
+		_request_memo.clear()
+
+def _memo_key(url, mode, headers=None, auth=None, proxy=None, useragent=None, **kwargs):
+	"""
+	:return: The key of a request in the memo, or None if it can't be memoized
+	"""
+	key = (url, mode, tuple(sorted(headers.items())) if headers else None,
+		   tuple(auth) if isinstance(auth, (tuple, list)) else auth,
+		   tuple(proxy) if isinstance(proxy, (tuple, list)) else proxy, useragent)
+	try:
+		hash(key)
+	except TypeError:
+		return None
+	return key
+
+def _is_valid_url(url):
+	if not isinstance(url, str):
+		return False
+	parts = urlsplit(url)
+	return parts.scheme in ("http", "https") and len(parts.netloc) > 0
+
+def _create_session():
+	session = requests.Session()
+	adapter = HTTPAdapter(pool_connections=_pool_connections, pool_maxsize=_pool_maxsize)
+	session.mount("http://", adapter)
+	session.mount("https://", adapter)
+	return session
 
 class Requestable:
-	rate_limit_wait = 1
+	rate_limit_wait = None		# Seconds between requests when not set in the service config, None to use [connection] ratelimit
+	rate_limit_burst = 1
+	_sessions_lock = Lock()
+	
+	def _get_session(self, url):
+		"""
+		Gets the keep-alive session used for the host of the URL, creating it on first use.
+		Sessions are owned by the handler so connections are reused across its requests.
+		:param url: The request URL
+		:return: A requests session
+		"""
+		host = urlsplit(url).netloc.lower()
+		with self._sessions_lock:
+			if "_sessions" not in self.__dict__:
+				self._sessions = dict()
+			session = self._sessions.get(host)
+			if session is None:
+				debug("Opening session for {}".format(host))
+				session = _create_session()
+				self._sessions[host] = session
+		return session
 	
-	@rate_limit(rate_limit_wait)
-	def request(self, url, json=False, xml=False, html=False, rss=False, proxy=None, useragent=None, auth=None, headers=None, timeout=10):
+	def close(self):
+		"""
+		Closes all sessions opened by this handler.
+		"""
+		with self._sessions_lock:
+			sessions = self.__dict__.pop("_sessions", dict())
+		for session in sessions.values():
+			session.close()
+	
+	def _get_rate_limiter(self, url):
+		"""
+		Gets the token bucket of the URL's host, using the ratelimit and ratelimit_burst
+		options of the handler's service section when present.
+		"""
+		config = getattr(self, "config", None) or dict()
+		wait_length = self.rate_limit_wait if self.rate_limit_wait is not None else _default_rate_limit
+		burst = self.rate_limit_burst
+		try:
+			if config.get("ratelimit", ""):
+				wait_length = float(config["ratelimit"])
+			if config.get("ratelimit_burst", ""):
+				burst = int(config["ratelimit_burst"])
+		except ValueError:
+			warning("Invalid rate limit in service config, using defaults")
+		return get_rate_limiter(urlsplit(url).netloc.lower(), max(wait_length, 0), max(burst, 1))
+	
+	def _request_sent(self, url):
+		"""
+		Called when a request got a response from the service, but not for memoized
+		responses or cached ones the service reported unchanged.
+		:param url: The request URL
+		"""
+		pass
+	
+	def _request_failed(self, url, status_code):
+		"""
+		Called when the service answered a request with an error status.
+		:param url: The request URL
+		:param status_code: The HTTP status code of the response
+		"""
+		pass
+	
+	def request(self, url, json=False, xml=False, html=False, rss=False, **kwargs):
+		"""
+		Sends a request to the service, or returns the parsed response if the same URL
+		was already requested in the same mode, with the same headers, auth and proxy, during this run.
+		Callers asking for a URL being fetched by another thread wait for that fetch.
+		See _send_request for the arguments.
+		:return: The response if successful, otherwise None
+		"""
+		mode = "json" if json else "xml" if xml else "html" if html else "rss" if rss else "text"
+		key = _memo_key(url, mode, **kwargs)
+		if key is None:
+			debug("Not memoizing request to {}".format(url))
+			return self._send_request(url, json=json, xml=xml, html=html, rss=rss, **kwargs)
+		with _request_memo_lock:
+			if key in _request_memo:
+				debug("Reusing response for {} ({})".format(url, mode))
+				return _request_memo[key]
+			pending = _request_pending.get(key)
+			is_owner = pending is None
+			if is_owner:
+				pending = _PendingRequest()
+				_request_pending[key] = pending
+		
+		if not is_owner:
+			debug("Waiting for pending request to {}".format(url))
+			pending.done.wait()
+			return pending.result
+		
+		try:
+			pending.result = self._send_request(url, json=json, xml=xml, html=html, rss=rss, **kwargs)
+		finally:
+			with _request_memo_lock:
+				# Failures aren't kept so a later call can try again
+				if pending.result is not None:
+					_request_memo[key] = pending.result
+				del _request_pending[key]
+			pending.done.set()
+		return pending.result
+	
+	def _send_request(self, url, json=False, xml=False, html=False, rss=False, proxy=None, useragent=None, auth=None, headers=None, timeout=10):
 		"""
 		Sends a request to the service.
 		:param url: The request URL
@@ -83,6 +327,10 @@ class Requestable:
 		:param timeout: Amount of time to wait for a response in seconds
 		:return: The response if successful, otherwise None
 		"""
+		if not _is_valid_url(url):
+			error("Invalid request URL: {}".format(url))
+			return None
+		
 		if proxy is not None:
 			if len(proxy) != 2:
 				warning("Invalid number of proxy values, need address and port")
@@ -91,48 +339,76 @@ class Requestable:
 				proxy = {"http": "http://{}:{}".format(*proxy)}
 				debug("Using proxy: {}", proxy)
 		
-		if headers == None:
-			headers = {}
+		# Copied since handlers pass shared header dicts
+		headers = dict(headers) if headers is not None else dict()
 		headers["User-Agent"] = useragent
+		
+		# Send the validators of a previous response so unchanged content isn't downloaded again
+		cached = _http_cache.get(url) if _http_cache is not None else None
+		if cached is not None:
+			if cached.get("etag"):
+				headers["If-None-Match"] = cached["etag"]
+			if cached.get("last_modified"):
+				headers["If-Modified-Since"] = cached["last_modified"]
+		
 		debug("Sending request")
 		debug("  URL={}".format(url))
 		debug("  Headers={}".format(headers))
 		try:
-			response = requests.get(url, headers=headers, proxies=proxy, auth=auth, timeout=timeout)
+			with _get_host_semaphore(urlsplit(url).netloc.lower()):
+				self._get_rate_limiter(url).acquire()
+				response = self._get_session(url).get(url, headers=headers, proxies=proxy, auth=auth, timeout=timeout)
 		except requests.exceptions.Timeout:
 			error("  Response timed out")
 			return None
 		debug("  Status code: {}".format(response.status_code))
-		if not response.ok or response.status_code == 204:		# 204 is a special case for MAL errors
-			error("Response {}: {}".format(response.status_code, response.reason))
-			return None
-		if len(response.text) == 0:		# Some sites *coughfunimationcough* may return successful empty responses for new shows
-			error("Empty response (probably funimation)")
-			return None
+		if response.status_code != 304 or cached is None:
+			self._request_sent(url)
+		if response.status_code == 304 and cached is not None:
+			debug("  Not modified, using cached response")
+			_http_cache.touch(url)
+			text = cached["body"]
+		else:
+			if not response.ok or response.status_code == 204:		# 204 is a special case for MAL errors
+				error("Response {}: {}".format(response.status_code, response.reason))
+				self._request_failed(url, response.status_code)
+				return None
+			text = response.text
+			if len(text) == 0:		# Some sites *coughfunimationcough* may return successful empty responses for new shows
+				error("Empty response (probably funimation)")
+				return None
+			
+			if _http_cache is not None:
+				etag = response.headers.get("ETag")
+				last_modified = response.headers.get("Last-Modified")
+				if etag or last_modified:
+					_http_cache.set(url, {"etag": etag, "last_modified": last_modified, "body": text})
+				elif cached is not None:
+					_http_cache.delete(url)
 		
 		if json:
 			debug("Response returning as JSON")
 			try:
-				return response.json()
+				return parse_json(text)
 			except JSONDecodeError as e:
 				error("Response is not JSON", exc_info=e)
 				return None
 		if xml:
 			debug("Response returning as XML")
 			#TODO: error checking
-			raw_entry = xml_parser.fromstring(response.text)
+			raw_entry = xml_parser.fromstring(text)
 			#entry = dict((attr.tag, attr.text) for attr in raw_entry)
 			return raw_entry
 		if html:
 			debug("Returning response as HTML")
-			soup = BeautifulSoup(response.text, 'html.parser')
+			soup = BeautifulSoup(text, 'html.parser')
 			return soup
 		if rss:
 			debug("Returning response as RSS feed")
-			rss = feedparser.parse(response.text)
+			rss = feedparser.parse(text)
 			return rss
 		debug("Response returning as text")
-		return response.text
+		return text
 
 ###################
 # Service handler #
@@ -142,6 +418,11 @@ from datetime import datetime
 from data.models import Episode, Stream, UnprocessedStream
 
 class AbstractServiceHandler(ABC, Requestable):
+	# True if get_recent_episodes fetches all streams together instead of calling get_all_episodes for each
+	bulk_recent_episodes = False
+	# True if get_all_episodes takes the latest posted episode of the stream's show as latest_episode
+	uses_latest_episode = False
+	
 	def __init__(self, key, name, is_generic):
 		self.key = key
 		self.name = name
@@ -170,6 +451,8 @@ class AbstractServiceHandler(ABC, Requestable):
 		:return: An iterable of live episodes
 		"""
 		episodes = self.get_all_episodes(stream, **kwargs)
+		if episodes is None:
+			return list()
 		today = datetime.utcnow().date()							#NOTE: Uses local time instead of UTC, but probably doesn't matter too much on a day scale
 		return filter(lambda e: e.date.date() <= today, episodes)	# Update 9/14/16: It actually matters.
 	
@@ -180,7 +463,7 @@ class AbstractServiceHandler(ABC, Requestable):
 		guaranteed to be returned due to potential API limitations.
 		:param stream: The stream being checked
 		:param kwargs: Arguments passed to the request, such as proxy and authentication
-		:return: A list of live episodes
+		:return: A list of live episodes, or None if the stream couldn't be requested
 		"""
 		return list()
 
@@ -193,7 +476,8 @@ class AbstractServiceHandler(ABC, Requestable):
 		:param streams: The streams for which new episodes must be returned.
 		:param kwargs: Arguments passed to the request, such as proxy and authentication
 		:return: A dict in which each key is one of the requested streams
-			 and the value is a list of newly released episodes for the stream
+			 and the value is a list of newly released episodes for the stream,
+			 or None if the stream couldn't be requested
 		"""
 		return {stream: self.get_all_episodes(stream, **kwargs) for stream in streams}
 	
@@ -395,11 +679,16 @@ def get_link_handler(link_site=None, key:str=None) -> Optional[AbstractInfoHandl
 ################
 
 from data.models import Poll
+from concurrent.futures import ThreadPoolExecutor
 
 class AbstractPollHandler(ABC, Requestable):
+	score_ttl = 300		# Seconds a fetched score is reused for before requesting it again
+	
 	def __init__(self, key):
 		self.key = key
 		self.config = None
+		self._scores = dict()		# poll id -> (fetch time, score)
+		self._scores_lock = Lock()
 
 	def set_config(self, config):
 		self.config = config
@@ -439,6 +728,38 @@ class AbstractPollHandler(ABC, Requestable):
 		:return: the score on a 1-10 scale
 		"""
 		return None
+	
+	def get_scores(self, polls: Iterable[Poll]) -> Dict[str, Optional[float]]:
+		"""
+		Returns the scores of many polls. Stored scores are used as-is, the others are requested concurrently
+		and reused for score_ttl seconds.
+		:param polls: the Poll objects
+		:return: a dict of poll ids to scores on a 1-10 scale
+		"""
+		scores = dict()
+		missing = list()
+		now = perf_counter()
+		with self._scores_lock:
+			for poll in polls:
+				if poll.has_score:
+					scores[poll.id] = poll.score
+				elif poll.id in self._scores and now - self._scores[poll.id][0] < self.score_ttl:
+					scores[poll.id] = self._scores[poll.id][1]
+				elif poll.id not in scores:
+					scores[poll.id] = None
+					missing.append(poll)
+		
+		if len(missing) > 0:
+			debug("Requesting {} poll scores".format(len(missing)))
+			# Concurrency per host is already capped by the request semaphore
+			with ThreadPoolExecutor(max_workers=min(len(missing), max(_host_connections, 1))) as pool:
+				fetched = list(pool.map(self.get_score, missing))
+			now = perf_counter()
+			with self._scores_lock:
+				for poll, score in zip(missing, fetched):
+					scores[poll.id] = score
+					self._scores[poll.id] = (now, score)
+		return scores
 
 _poll_sites = dict()
 
@@ -0,0 +1,108 @@
+from logging import debug, warning
+import os, json, hashlib, tempfile, time
+from threading import Lock
+
+class DiskCache:
+	"""
+	Small persistent key-value store, one JSON file per key.
+	Writes are atomic so concurrent readers never see a partial entry.
+	Keys are only stored hashed since they may hold secrets, such as API keys in URLs.
+	"""
+	def __init__(self, directory):
+		self.directory = directory
+		self._lock = Lock()
+
+	def _path(self, key):
+		return os.path.join(self.directory, _hash_key(key) + ".json")
+
+	def get(self, key, default=None):
+		"""
+		Gets the value stored for a key.
+		:param key: The entry key
+		:param default: Value returned if the entry is missing or unreadable
+		:return: The stored value
+		"""
+		try:
+			with open(self._path(key), "r", encoding="utf-8") as f:
+				entry = json.load(f)
+		except FileNotFoundError:
+			return default
+		except (OSError, ValueError):
+			warning("Unreadable cache entry for {}".format(key))
+			return default
+		if entry.get("key") != _hash_key(key, "sha256"):
+			return default
+		return entry.get("value", default)
+
+	def set(self, key, value):
+		"""
+		Stores a JSON-serializable value for a key.
+		:param key: The entry key
+		:param value: The value to store
+		"""
+		tmp_path = None
+		try:
+			with self._lock:
+				os.makedirs(self.directory, exist_ok=True)
+			fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+			with os.fdopen(fd, "w", encoding="utf-8") as f:
+				json.dump({"key": _hash_key(key, "sha256"), "value": value}, f)
+			os.replace(tmp_path, self._path(key))
+		except (OSError, TypeError, ValueError):
+			warning("Failed to write cache entry for {}".format(key))
+			if tmp_path is not None and os.path.exists(tmp_path):
+				os.remove(tmp_path)
+
+	def delete(self, key):
+		"""
+		Removes the entry of a key if it exists.
+		"""
+		try:
+			os.remove(self._path(key))
+			debug("Removed cache entry for {}".format(key))
+		except FileNotFoundError:
+			pass
+	
+	def touch(self, key):
+		"""
+		Marks the entry of a key as used, so pruning keeps it.
+		"""
+		try:
+			os.utime(self._path(key))
+		except OSError:
+			pass
+	
+	def prune(self, max_age=None, max_entries=None):
+		"""
+		Removes entries not written or touched in a while, then the oldest entries past a count.
+		:param max_age: Seconds after which an entry is removed, None to keep entries of any age
+		:param max_entries: Number of entries kept, None for no limit
+		"""
+		try:
+			names = [name for name in os.listdir(self.directory) if name.endswith(".json")]
+		except FileNotFoundError:
+			return
+		entries = list()
+		for name in names:
+			path = os.path.join(self.directory, name)
+			try:
+				entries.append((os.path.getmtime(path), path))
+			except OSError:
+				pass
+		entries.sort(reverse=True)
+		
+		now = time.time()
+		removed = list()
+		for n, (mtime, path) in enumerate(entries):
+			if (max_age is not None and now - mtime > max_age) or (max_entries is not None and n >= max_entries):
+				removed.append(path)
+		for path in removed:
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+		if len(removed) > 0:
+			debug("Pruned {} of {} cache entries in {}".format(len(removed), len(entries), self.directory))
+
+def _hash_key(key, algorithm="sha1"):
+	return hashlib.new(algorithm, key.encode("utf-8")).hexdigest()
@@ -1,6 +1,5 @@
 from logging import debug, info, warning, error
 from datetime import datetime, timezone
-import requests
 import re
 
 from .. import AbstractPollHandler
@@ -47,8 +46,9 @@ class PollHandler(AbstractPollHandler):
 		data = self._poll_post_data
 		data['poll-1[question]'] = title
 		#resp = requests.post(_poll_post_url, data = data, headers = headers, **kwargs)
+		self._get_rate_limiter(self._poll_post_url).acquire()
 		try:
-			resp = requests.post(self._poll_post_url, data = data, **kwargs)
+			resp = self._get_session(self._poll_post_url).post(self._poll_post_url, data = data, **kwargs)
 		except:
 			error("Could not create poll (exception in POST)")
 			return None
@@ -1,8 +1,9 @@
 from logging import debug, info, warning, error, exception
 import re
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
-from .. import AbstractServiceHandler
+from .. import AbstractServiceHandler, get_fetch_workers
 from data.models import Episode, UnprocessedStream
 
 class ServiceHandler(AbstractServiceHandler):
@@ -15,6 +16,8 @@ class ServiceHandler(AbstractServiceHandler):
 	_backup_rss = "http://crunchyroll.com/rss/anime"
 	_season_url = "http://crunchyroll.com/lineup"
 	
+	bulk_recent_episodes = True
+	
 	def __init__(self):
 		super().__init__("crunchyroll", "Crunchyroll", False)
 	
@@ -23,25 +26,50 @@ class ServiceHandler(AbstractServiceHandler):
 	def get_all_episodes(self, stream, **kwargs):
 		info("Getting live episodes for Crunchyroll/{}".format(stream.show_key))
 		episode_datas = self._get_feed_episodes(stream.show_key, **kwargs)
+		if episode_datas is None:
+			return None
+		return _digest_episodes(episode_datas, stream.show_key)
+	
+	def get_recent_episodes(self, streams, **kwargs):
+		"""
+		Returns the recent episodes of all streams from the global feed, requested once.
+		Streams the global feed can't resolve fall back to their own feed: new-style series keys, which
+		episode links don't contain, and every stream missing from the feed if it doesn't go back as far
+		as episodes are considered recent.
+		Only streams due this run are given, so fallback feeds follow adaptive polling.
+		"""
+		streams = list(streams)
+		info("Getting recent episodes of {} streams from the global Crunchyroll feed".format(len(streams)))
+		feed_episodes = self._get_feed_episodes(None, **kwargs) or list()
+		covers_recent = _covers_recent_episodes(feed_episodes)
+		slug_episodes = dict()
+		for feed_episode in feed_episodes:
+			slug = _get_slug(feed_episode.get("link", ""))
+			if slug is not None:
+				slug_episodes.setdefault(slug.lower(), list()).append(feed_episode)
 		
-		# Check data validity and digest
-		episodes = []
-		for episode_data in episode_datas:
-			if _is_valid_episode(episode_data, stream.show_key):
-				try:
-					episodes.append(_digest_episode(episode_data))
-				except:
-					exception("Problem digesting episode for Crunchyroll/{}".format(stream.show_key))
+		episodes = dict()
+		fallback_streams = list()
+		for stream in streams:
+			show_key = stream.show_key.lower() if stream.show_key is not None else None
+			if show_key in slug_episodes:
+				episodes[stream] = _digest_episodes(slug_episodes[show_key], stream.show_key)
+			elif covers_recent and show_key is not None and not show_key.startswith("series/"):
+				episodes[stream] = list()
+			else:
+				fallback_streams.append(stream)
 		
-		if len(episode_datas) > 0:
-			debug("  {} episodes found, {} valid".format(len(episode_datas), len(episodes)))
-		else:
-			debug("  No episodes found")
+		if len(fallback_streams) > 0:
+			info("  Using show feeds for {} streams".format(len(fallback_streams)))
+			# Requests to the host are still limited by its semaphore and rate limiter
+			with ThreadPoolExecutor(max_workers=min(len(fallback_streams), get_fetch_workers())) as pool:
+				fallback_episodes = pool.map(lambda stream: self.get_all_episodes(stream, **kwargs), fallback_streams)
+				episodes.update(zip(fallback_streams, fallback_episodes))
 		return episodes
 	
 	def _get_feed_episodes(self, show_key, **kwargs):
 		"""
-		Always returns a list.
+		:return: The feed entries, or None if the feed couldn't be requested
 		"""
 		info("Getting episodes for Crunchyroll/{}".format(show_key))
 		
@@ -51,7 +79,7 @@ class ServiceHandler(AbstractServiceHandler):
 		response = self.request(url, rss=True, **kwargs)
 		if response is None:
 			error("Cannot get latest show for Crunchyroll/{}".format(show_key))
-			return list()
+			return None
 		
 		# Parse RSS feed
 		if not _verify_feed(response):
@@ -168,6 +196,33 @@ def _verify_feed(feed):
 	return True
 
 
+def _digest_episodes(episode_datas, show_key):
+	# Check data validity and digest
+	episodes = []
+	for episode_data in episode_datas:
+		if _is_valid_episode(episode_data, show_key):
+			try:
+				episodes.append(_digest_episode(episode_data))
+			except:
+				exception("Problem digesting episode for Crunchyroll/{}".format(show_key))
+	
+	if len(episode_datas) > 0:
+		debug("  {} episodes found, {} valid".format(len(episode_datas), len(episodes)))
+	else:
+		debug("  No episodes found")
+	return episodes
+
+def _covers_recent_episodes(feed_episodes):
+	"""
+	Checks if a feed goes back as far as episodes are considered recent by _is_valid_episode.
+	"""
+	try:
+		oldest = min(datetime(*feed_episode.published_parsed[:6]) for feed_episode in feed_episodes)
+	except (AttributeError, TypeError, ValueError):
+		# Empty feed or entries without a date
+		return False
+	return datetime.utcnow() - oldest >= timedelta(days=2)
+
 def _is_valid_episode(feed_episode, show_id):
 	# We don't want non-episodes (PVs, VA interviews, etc.)
 	if feed_episode.get("crunchyroll_isclip", False) or not hasattr(feed_episode, "crunchyroll_episodenumber"):
@@ -1,8 +1,9 @@
 from logging import debug, info, warning, error, exception
-import re
+import re, json, base64, time
 from datetime import datetime, timedelta
+from threading import RLock
 
-from .. import AbstractServiceHandler
+from .. import AbstractServiceHandler, get_disk_cache
 from data.models import Episode, UnprocessedStream
 
 class ServiceHandler(AbstractServiceHandler):
@@ -24,15 +25,25 @@ class ServiceHandler(AbstractServiceHandler):
                     'Origin': 'https://www.hidive.com'
                    }
     _api_auth_token = None
+    _api_auth_expires = 0
+    _api_auth_lock = RLock()
+    # Used when the token doesn't say when it expires
+    _api_auth_ttl = 3600
+
+    uses_latest_episode = True
 
     def __init__(self):
         super().__init__("hidive", "HIDIVE", False)
 
     # Episode finding
 
-    def get_all_episodes(self, stream, **kwargs):
+    def get_all_episodes(self, stream, latest_episode=None, **kwargs):
         info(f"Getting live episodes for HiDive/{stream.show_key}")
-        episode_datas = self._get_feed_episodes(stream.show_key, **kwargs)
+        # Pages older than the latest posted episode, in the stream's numbering, are skipped
+        high_water = latest_episode.number + stream.remote_offset if latest_episode is not None else None
+        episode_datas = self._get_feed_episodes(stream.show_key, high_water, **kwargs)
+        if episode_datas is None:
+            return None
 
         # Check episode validity and digest
         episodes = []
@@ -51,12 +62,36 @@ class ServiceHandler(AbstractServiceHandler):
             debug("  No episode found")
         return episodes
 
-    def _get_feed_episodes(self, show_key, **kwargs):
+    def _get_feed_episodes(self, show_key, high_water=None, **kwargs):
         info(f"Getting episodes for HiDive/{show_key}")
 
-        headers = self._api_headers
-        headers['Authorization'] = "Bearer " + self._get_api_auth_token()
-        last_seen = None
+        # Resume from the page holding the latest posted episode, older pages only hold posted episodes
+        cache = get_disk_cache("hidive")
+        cursor = cache.get("high_water:" + str(show_key)) if high_water is not None else None
+        episodes = None
+        if cursor is not None and cursor["episode"] <= high_water:
+            episodes = self._get_feed_pages(show_key, cursor["last_seen"], high_water, **kwargs)
+            if episodes is None:
+                return None
+            if not any(_episode_number(ep) == cursor["episode"] for ep, _ in episodes):
+                debug("  Posted episode not found from cursor, getting all pages")
+                episodes = None
+
+        if episodes is None:
+            episodes = self._get_feed_pages(show_key, high_water=high_water, **kwargs)
+            if episodes is None:
+                return None
+        if high_water is not None:
+            self._set_high_water(show_key, episodes, high_water)
+        return [ep for ep, _ in episodes]
+
+    def _get_feed_pages(self, show_key, last_seen=None, high_water=None, **kwargs):
+        """
+        Gets the available episodes of a show, starting from a page cursor.
+        :param last_seen: The cursor of the first page, None to start from the first page
+        :param high_water: Episode number at or below which a page of descending episodes ends the walk
+        :return: A list of episodes with the cursor of their page, or None if a page couldn't be requested
+        """
         episodes = []
 
         # This will cover the first 400 episodes. Currently, the odds of a Hidive
@@ -65,18 +100,24 @@ class ServiceHandler(AbstractServiceHandler):
         # stall holo forever.
         for _ in range(20):
             url = self._get_feed_url(show_key, last_seen)
-            response = self.request(url, json=True, headers=headers, **kwargs)
+            response = self._request_api(url, **kwargs)
             if response is None:
                 error(f"Cannot get show page for HiDive/{show_key}")
-                return list()
+                return None
 
             for ep in response['episodes']:
                 if "onlinePlayback" in ep:
                     if ep["onlinePlayback"] == "AVAILABLE":
-                        episodes.append(ep)
+                        episodes.append((ep, last_seen))
                 else:
                     warning("  HiDive API returned JSON not matching expectations: onlinePlayback")
 
+            # Newest first, every following page is older
+            numbers = [n for n in map(_episode_number, response['episodes']) if n is not None]
+            if high_water is not None and len(numbers) > 1 and numbers == sorted(numbers, reverse=True) and numbers[-1] <= high_water:
+                debug("  Reached posted episodes")
+                break
+
             if ( "paging" in response and "moreDataAvailable" in response["paging"]
                   and "lastSeen" in response["paging"]):
                 if response["paging"]["moreDataAvailable"]:
@@ -90,6 +131,13 @@ class ServiceHandler(AbstractServiceHandler):
 
         return episodes
 
+    @staticmethod
+    def _set_high_water(show_key, episodes, high_water):
+        # Kept as is if the posted episode isn't listed, such as one posted from another service
+        for ep, last_seen in episodes:
+            if _episode_number(ep) == high_water:
+                get_disk_cache("hidive").set("high_water:" + str(show_key), {"episode": high_water, "last_seen": last_seen})
+                return
 
     @classmethod
     def _get_feed_url(cls, show_key, last_seen=None):
@@ -102,21 +150,63 @@ class ServiceHandler(AbstractServiceHandler):
         else:
             return None
 
-    @classmethod
-    def _get_api_auth_token(cls):
-        # The auth token easily lasts a full holo run, so we assume any one we have is valid.
-        # If just getting through all HiDive shows takes longer than the token lasts,
-        # we have far greater issues.
-        if cls._api_auth_token:
-            debug("  HiDive API key from cache")
-            return cls._api_auth_token
-
-        init = cls.request(cls, "https://dce-frontoffice.imggaming.com/api/v1/init",
-                            headers=cls._api_headers, json=True)
-        tok = init['authentication']['authorisationToken']
-        cls._api_auth_token = tok
-        debug("  HiDive API key from endpoint")
-        return tok
+    def _request_api(self, url, **kwargs):
+        """
+        Requests the API with the bearer token. A token refused by the API is dropped
+        by _request_failed, then the request is sent once more with a new token.
+        """
+        token = self._get_api_auth_token()
+        if token is None:
+            return None
+        response = self.request(url, json=True, headers=dict(self._api_headers, Authorization="Bearer " + token), **kwargs)
+        if response is None and ServiceHandler._api_auth_token != token:
+            info("  HiDive API key refused, retrying with a new one")
+            token = self._get_api_auth_token()
+            if token is None:
+                return None
+            response = self.request(url, json=True, headers=dict(self._api_headers, Authorization="Bearer " + token), **kwargs)
+        return response
+
+    def _request_failed(self, url, status_code):
+        if status_code in (401, 403):
+            with ServiceHandler._api_auth_lock:
+                ServiceHandler._api_auth_token = None
+                ServiceHandler._api_auth_expires = 0
+                get_disk_cache("hidive").delete("auth_token")
+
+    def _get_api_auth_token(self):
+        # The token is kept on disk until shortly before it expires, so it is shared by
+        # every holo run instead of being requested again each time.
+        with ServiceHandler._api_auth_lock:
+            if ServiceHandler._api_auth_token and time.time() < ServiceHandler._api_auth_expires:
+                debug("  HiDive API key from cache")
+                return ServiceHandler._api_auth_token
+
+            cache = get_disk_cache("hidive")
+            stored = cache.get("auth_token")
+            if stored is not None and time.time() < stored["expires"]:
+                debug("  HiDive API key from disk cache")
+                ServiceHandler._api_auth_token = stored["token"]
+                ServiceHandler._api_auth_expires = stored["expires"]
+                return stored["token"]
+
+            # Not memoized, a new token must be requested after one was refused
+            init = self._send_request("https://dce-frontoffice.imggaming.com/api/v1/init",
+                                      headers=self._api_headers, json=True)
+            if init is None:
+                error("  Cannot get HiDive API key")
+                return None
+            tok = init['authentication']['authorisationToken']
+            expires = _token_expiry(tok)
+            if expires is None:
+                expires = time.time() + self._api_auth_ttl
+            # Leave a margin so a token never expires in the middle of a run
+            expires -= 300
+            ServiceHandler._api_auth_token = tok
+            ServiceHandler._api_auth_expires = expires
+            cache.set("auth_token", {"token": tok, "expires": expires})
+            debug("  HiDive API key from endpoint")
+            return tok
 
 
 
@@ -126,9 +216,7 @@ class ServiceHandler(AbstractServiceHandler):
         info(f"Getting stream info for HiDive/{stream.show_key}")
 
         url = self._get_feed_url(stream.show_key)
-        headers = self._api_headers
-        headers['Authorization'] = "Bearer " + self._get_api_auth_token()
-        response = self.request(url, json=true, headers=headers, **kwargs)
+        response = self._request_api(url, **kwargs)
         if response is None:
             error("Cannot get feed")
             return None
@@ -153,6 +241,25 @@ class ServiceHandler(AbstractServiceHandler):
                 return match.group(1)
         return None
 
+def _token_expiry(token):
+    """
+    Reads the expiry of a JWT bearer token.
+    :return: The expiry as a timestamp, or None if the token doesn't have one
+    """
+    try:
+        payload = token.split(".")[1]
+        payload = base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+        return float(json.loads(payload)["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        debug("  HiDive API key has no readable expiry")
+        return None
+
+def _episode_number(episode_data):
+    try:
+        return episode_data["episodeInformation"]["episodeNumber"]
+    except (KeyError, TypeError):
+        return None
+
 def _is_valid_episode(episode_data, show_key):
     if ( "episodeInformation" in episode_data
          and "episodeNumber" in episode_data["episodeInformation"]
@@ -4,6 +4,8 @@
 from logging import debug, info, warning, error, exception
 from datetime import datetime, timedelta
 import re
+from collections import Counter, defaultdict
+from functools import lru_cache
 from urllib.parse import quote_plus as url_quote
 
 from .. import AbstractServiceHandler
@@ -13,6 +15,8 @@ class ServiceHandler(AbstractServiceHandler):
 	_search_base = "https://{domain}/?page=rss&c=1_2&f={filter}&q={q}&exclude={excludes}"
 	_recent_list = "https://{domain}/?page=rss&c=1_2&f={filter}&exclude={excludes}"
 	
+	bulk_recent_episodes = True
+	
 	def __init__(self):
 		super().__init__("nyaa", "Nyaa", True)
 	
@@ -45,10 +49,11 @@ class ServiceHandler(AbstractServiceHandler):
 		Return a list of episodes for each stream.
 		"""
 		torrents = self._get_recent_torrents(**kwargs)
+		matcher = _StreamMatcher(streams)
 		episodes = dict()
 
 		for torrent in torrents:
-			found_streams = self._find_matching_stream(torrent, streams)
+			found_streams = matcher.match(torrent.title)
 
 			if not _is_valid_episode(torrent):
 				debug("Torrent excluded (not a valid episode format)")
@@ -67,33 +72,6 @@ class ServiceHandler(AbstractServiceHandler):
 					exception(f"Problem digesting torrent {torrent.id}")
 		return episodes
 
-	def _find_matching_stream(self, torrent, streams):
-		debug(f"Searching matching stream for torrent {torrent.title}")
-		found_streams = list()
-
-		for stream in streams:
-			show = stream.show
-			names = [show.name] + show.aliases + [stream.show_key]
-
-			if show.name_en:
-				names.append(show.name_en)
-
-			for name in names:
-				#debug(f"  Trying: {name}")
-				# Match if each word in the show name is in the torrent name
-				# Intent is to allow inclusion of fansub group names
-				words_show = set(_normalize_show_name(name).split())
-				words_torrent = set(_normalize_show_name(torrent.title).split())
-				if words_show.issubset(words_torrent):
-					debug(f"  -> MATCH")
-					info(f"Matching found for torrent {torrent.title}")
-					info(f"  -> {show.name}")
-					found_streams.append(stream)
-					break
-		if not found_streams:
-			debug(f"No matching show found for torrent {torrent.title}")
-		return found_streams
-
 	def _get_recent_torrents(self, **kwargs):
 		"""
 		Returns all torrents on the top of https://nyaa.si/?c=1_2.
@@ -170,7 +148,8 @@ def _verify_feed(feed):
 	return True
 
 def _is_valid_episode(feed_episode):
-	if any(ex.search(feed_episode["title"]) is not None for ex in _exludors):
+	excluded, number = _classify_title(feed_episode["title"])
+	if excluded:
 		debug("  Excluded")
 		return False
 	episode_date = datetime(*feed_episode.published_parsed[:6])
@@ -178,7 +157,6 @@ def _is_valid_episode(feed_episode):
 	if date_diff >= timedelta(days=2):
 		debug("  Episode too old")
 		return False
-	number = _extract_episode_num(feed_episode["title"])
 	if number is None or number <= 0:
 		debug(f"  Probably not the right episode number ({number})")
 		return False
@@ -196,49 +174,122 @@ def _digest_episode(feed_episode):
 	debug("  No match found")
 	return None
 
-_exludors = [re.compile(x, re.I) for x in [
-	"\.srt$",
+_exludor = re.compile("|".join("(?:{})".format(x) for x in [
+	r"\.srt$",
 	r"\b(batch|vol(ume|\.)? ?\d+|dub|dubbed)\b",
 	r"\b(bd(?:remux|rip)?|bluray)\b",
 	r"PV.?\d+",
 	r"pre-?air",
 	r"(blackjaxx|daddy|le m[eê]me|Almighty|suskorin|S1PH3R|KawaSubs)", # blacklisted uploaders
-]]
-_num_extractors = [re.compile(x, re.I) for x in [
+]), re.I)
+
+# Extractors are tried in order. Those restricted to groups only apply to titles starting with one of
+# the group tags, and are written without it (ex. "[SubsPlease] Show - 01 [1080p].mkv" for " .+ - (\d+) ")
+_num_extractors = [(groups, re.compile(x if groups is None else r"\[(?:{})\]".format("|".join(map(re.escape, groups))) + x, re.I)) for groups, x in [
 	# " - " separator between show and episode
-	r"\[(?:horriblesubs|SubsPlease|commie|hiryuu|kuusou|fff|merchant|lolisubs|hitoku|erai-raws|davinci|asenshi|mezashite|anonyneko|pas|ryuujitk|rip time|yaneura)\] .+ - (\d+) ",
-	r"\[DameDesuYo\] .+ - (\d+)[ v]",
-	r"\[Some-Stuffs\] .+ (\d{3}) ",
-	r"\[(?:orz|hayaku|sxrp|Weeaboo-Shogun)\] .+ (\d+)", # No separator
-	r"\[(?:kaitou|gg)\]_.+_-_(\d+)_", # "_-_" separator
-	r"\[flysubs].+ - (\d+)\[.+\]", # "_-_" separator
-	r".+_(\d+)\[(?:please_sub_this_viz)\]", # "_-_" separator
-	r"\[doremi\]\..+\.(\d+)", # "." separator
-	r"\[anon\] .+? (\d{2,})",
-	r"\[seiya\] .+ - (\d+) \[.+\]",
-	r"\[U3-Web\] .+ \[EP(\d+)\]",
-	r"\[ember\] .+ s(?:\d+)e(\d+)",
-	r".+ (\d+) \[(?:Anon-kun Wa Sugoi)\]", # Group after title, spaces
-	r"(?:.+).S(?:\d+)E(\d+).Laelaps.Calling.(?:\d+)p.(?:.+)",
-	r"\[(?:SenritsuSubs|AtlasSubbed|Rakushun)\] .+ - (\d+)",
-	#r".+ - S(?:\d+)E(\d+) ", # using the S01E12 format
-	r".+\Ws(?:eason)?[\s.]?\d+[\s.]?e(?:pisode)?[\s.]?(\d+)", # SxxEyy format (allow s/season, e/episode, ./space separation
-	r"\[.*?\][ _][^\(\[]+[ _](?:-[ _])?(\d+)[ _]", # Generic to make a best guess. Does not include . separation due to the common "XXX vol.01" format
-	r".*?[ _](\d+)[ _]\[\d+p\]", # No tag followed by quality
-	r".*?episode[ _](\d+)", # Completely unformatted, but with the "Episode XX" text
-	r".*[ _]-[ _](\d+)(?:[ _].*)?$", # - separator
-	r".*(\d+)\.mkv$", # num right before extension
+	(["horriblesubs", "SubsPlease", "commie", "hiryuu", "kuusou", "fff", "merchant", "lolisubs", "hitoku", "erai-raws", "davinci", "asenshi", "mezashite", "anonyneko", "pas", "ryuujitk", "rip time", "yaneura"], r" .+ - (\d+) "),
+	(["DameDesuYo"], r" .+ - (\d+)[ v]"),
+	(["Some-Stuffs"], r" .+ (\d{3}) "),
+	(["orz", "hayaku", "sxrp", "Weeaboo-Shogun"], r" .+ (\d+)"), # No separator
+	(["kaitou", "gg"], r"_.+_-_(\d+)_"), # "_-_" separator
+	(["flysubs"], r".+ - (\d+)\[.+\]"), # "_-_" separator
+	(None, r".+_(\d+)\[(?:please_sub_this_viz)\]"), # "_-_" separator
+	(["doremi"], r"\..+\.(\d+)"), # "." separator
+	(["anon"], r" .+? (\d{2,})"),
+	(["seiya"], r" .+ - (\d+) \[.+\]"),
+	(["U3-Web"], r" .+ \[EP(\d+)\]"),
+	(["ember"], r" .+ s(?:\d+)e(\d+)"),
+	(None, r".+ (\d+) \[(?:Anon-kun Wa Sugoi)\]"), # Group after title, spaces
+	(None, r"(?:.+).S(?:\d+)E(\d+).Laelaps.Calling.(?:\d+)p.(?:.+)"),
+	(["SenritsuSubs", "AtlasSubbed", "Rakushun"], r" .+ - (\d+)"),
+	#(None, r".+ - S(?:\d+)E(\d+) "), # using the S01E12 format
+	(None, r".+\Ws(?:eason)?[\s.]?\d+[\s.]?e(?:pisode)?[\s.]?(\d+)"), # SxxEyy format (allow s/season, e/episode, ./space separation
+	(None, r"\[.*?\][ _][^\(\[]+[ _](?:-[ _])?(\d+)[ _]"), # Generic to make a best guess. Does not include . separation due to the common "XXX vol.01" format
+	(None, r".*?[ _](\d+)[ _]\[\d+p\]"), # No tag followed by quality
+	(None, r".*?episode[ _](\d+)"), # Completely unformatted, but with the "Episode XX" text
+	(None, r".*[ _]-[ _](\d+)(?:[ _].*)?$"), # - separator
+	(None, r".*(\d+)\.mkv$"), # num right before extension
 ]]
 
+def _combine_extractors(extractors):
+	# Alternatives are tried in order at the start of the title, the same as matching each pattern in turn
+	return re.compile("|".join("(?:{})".format(regex.pattern) for regex in extractors), re.I)
+
+# One combined extractor per group tag holding its own patterns and the generic ones, keeping their order
+_generic_num_extractor = _combine_extractors([regex for groups, regex in _num_extractors if groups is None])
+_group_num_extractors = {group.casefold(): _combine_extractors([regex for groups, regex in _num_extractors if groups is None or group in groups])
+						 for groups, _ in _num_extractors if groups is not None for group in groups}
+_group_tag = re.compile(r"\[([^\]]*)\]")
+
+@lru_cache(maxsize=4096)
+def _classify_title(name):
+	"""
+	Classifies a torrent title in a single pass, cached since the same torrents come back every run.
+	:return: A tuple of whether the title is excluded and its episode number, or None if not found
+	"""
+	if _exludor.search(name) is not None:
+		return True, None
+	tag = _group_tag.match(name)
+	extractor = _group_num_extractors.get(tag.group(1).casefold(), _generic_num_extractor) if tag else _generic_num_extractor
+	match = extractor.match(name)
+	if match is not None:
+		return False, int(next(num for num in match.groups() if num is not None))
+	return False, None
+
 def _extract_episode_num(name):
-	if any(ex.search(name) is not None for ex in _exludors):
-		return None
-	for regex in _num_extractors:
-		match = regex.match(name)
-		if match is not None:
-			num = int(match.group(1))
-			return num
-	return None
+	return _classify_title(name)[1]
+
+class _StreamMatcher:
+	"""
+	Matches torrent titles to streams. A title matches a stream if every word of one of the
+	stream's names is in the title, which allows extra words such as fansub group names.
+	Each name is indexed under its rarest word so a title is only compared to names sharing one of its words.
+	"""
+	def __init__(self, streams):
+		self._streams = list(streams)
+		names = list()
+		for position, stream in enumerate(self._streams):
+			for name in _get_stream_names(stream):
+				names.append((position, frozenset(_normalize_show_name(name).split())))
+
+		word_counts = Counter(word for _, words in names for word in words)
+		self._index = defaultdict(list)
+		self._match_all = list()			# Names without any word are contained in every title
+		for position, words in names:
+			if words:
+				rarest = min(words, key=lambda word: (word_counts[word], word))
+				self._index[rarest].append((position, words))
+			else:
+				self._match_all.append(position)
+		debug(f"Indexed {len(names)} names of {len(self._streams)} streams")
+
+	def match(self, title):
+		"""
+		Returns the matching streams, in the order they were given.
+		"""
+		debug(f"Searching matching stream for torrent {title}")
+		words_torrent = set(_normalize_show_name(title).split())
+
+		found = set(self._match_all)
+		for word in words_torrent:
+			for position, words_show in self._index.get(word, ()):
+				if position not in found and words_show <= words_torrent:
+					found.add(position)
+
+		found_streams = [self._streams[position] for position in sorted(found)]
+		for stream in found_streams:
+			info(f"Matching found for torrent {title}")
+			info(f"  -> {stream.show.name}")
+		if not found_streams:
+			debug(f"No matching show found for torrent {title}")
+		return found_streams
+
+def _get_stream_names(stream):
+	show = stream.show
+	names = [show.name] + show.aliases + [stream.show_key]
+	if show.name_en:
+		names.append(show.name_en)
+	return names
 
 def _normalize_show_name(name):
 	"""
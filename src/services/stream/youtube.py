@@ -1,8 +1,12 @@
 from logging import debug, info, warning, error, exception
-import re
-from datetime import datetime, timedelta
+import re, hashlib
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
-from .. import AbstractServiceHandler
+from .. import AbstractServiceHandler, get_disk_cache, get_fetch_workers
 from data.models import Episode, UnprocessedStream
 
 class ServiceHandler(AbstractServiceHandler):
@@ -11,68 +15,137 @@ class ServiceHandler(AbstractServiceHandler):
 	_channel_url = "https://www.youtube.com/playlist?list={id}"
 	_channel_re = re.compile("youtube.com/playlist\\?list=([\w-]+)", re.I)
 
+	bulk_recent_episodes = True
+
 	def __init__(self):
 		super().__init__("youtube", "Youtube", False)
 
 	# Episode finding
 
 	def get_all_episodes(self, stream, **kwargs):
-		info(f"Getting live episodes for Youtube/{stream.show_key}")
-		episode_datas = self._get_feed_episodes(stream.show_key, **kwargs)
-
-		# Extract valid episodes from feed and digest
-		episodes = []
-		for episode_data in episode_datas:
-			if _is_valid_episode(episode_data, stream.show_key):
-				try:
-					episode = _digest_episode(episode_data)
-					if episode is not None:
-						episodes.append(episode)
-				except:
-					exception(f"Problem digesting episode for Youtube/{stream.show_key}")
-
-		if len(episode_datas) > 0:
-			debug("  {} episodes found, {} valid".format(len(episode_datas), len(episodes)))
-		else:
-			debug("  No episodes found")
+		return self.get_recent_episodes([stream], **kwargs).get(stream, list())
+
+	def get_recent_episodes(self, streams, **kwargs):
+		"""
+		Gets the playlists of all streams, then resolves their new videos together in batches of 50.
+		Videos seen in earlier runs are only resolved again while upcoming or private.
+		Every request is counted against the daily quota of the API key, and skipped once the quota
+		reserve is reached.
+		"""
+		streams = list(streams)
+		api_key = self._get_api_key()
+		if api_key is None or len(streams) == 0:
+			return dict()
+
+		info(f"Getting live episodes of {len(streams)} playlists for {self.name}")
+		with ThreadPoolExecutor(max_workers=min(len(streams), get_fetch_workers())) as pool:
+			playlists = list(pool.map(lambda stream: self._get_playlist(stream.show_key, api_key, **kwargs), streams))
+
+		# Only videos never classified, or not online yet, are resolved
+		seen = [_seen_videos.get(stream.show_key) if playlist is not None else None for stream, playlist in zip(streams, playlists)]
+		unresolved = list()
+		for playlist, playlist_seen in zip(playlists, seen):
+			if playlist is None:
+				continue
+			video_ids, etag = playlist
+			unresolved.extend(video_id for video_id in video_ids if playlist_seen["videos"].get(video_id, _pending)["status"] == "pending")
+		unresolved = list(OrderedDict.fromkeys(unresolved))
+		videos = self._get_videos(unresolved, api_key, **kwargs)
+
+		# Streams whose playlist couldn't be requested are left out
+		episodes = dict()
+		for stream, playlist, playlist_seen in zip(streams, playlists, seen):
+			if playlist is None:
+				continue
+			video_ids, etag = playlist
+			resolved = [video_id for video_id in video_ids if video_id in videos]
+			if etag is not None and etag == playlist_seen["etag"] and len(resolved) == 0 and len(video_ids) == len(playlist_seen["videos"]):
+				# Playlist unchanged and nothing newly resolved, the stored videos are still current
+				debug(f"  Playlist {stream.show_key} unchanged")
+				classified = playlist_seen["videos"]
+			else:
+				classified = {video_id: playlist_seen["videos"].get(video_id) for video_id in video_ids}
+				for video_id in resolved:
+					classified[video_id] = _classify_video(videos[video_id], stream.show_key)
+				# Videos that couldn't be resolved are left out and resolved on the next run
+				classified = {video_id: video for video_id, video in classified.items() if video is not None}
+				_seen_videos.set(stream.show_key, etag, classified)
+			episodes[stream] = [_to_episode(video) for video in classified.values() if video["status"] == "valid"]
+			debug(f"  {len(video_ids)} videos in playlist {stream.show_key}, {len(episodes[stream])} valid")
 		return episodes
 
-	def _get_feed_episodes(self, show_key, **kwargs):
+	def _get_playlist(self, show_key, api_key, **kwargs):
+		"""
+		:return: The video IDs in the playlist and the etag of the playlist, or None if it couldn't be requested
+		"""
 		url = self._get_feed_url(show_key)
 		if url is None:
 			error(f"Cannot get feed url for {self.name}/{show_key}")
+			return None
+		if not self._has_quota(api_key, 1):
+			return None
 
 		# Request channel information
 		response = self.request(url, json=True, **kwargs)
 		if response is None:
 			error(f"Cannot get episode feed for {self.name}/{show_key}")
-			return list()
+			return None
 
-		# Extract videos ids and build new query for all videos
 		if not _verify_feed(response):
 			warning("Parsed feed could not be verified, may have unexpected results")
-		feed = response.get("items", list())
+		return [item["contentDetails"]["videoId"] for item in response.get("items", list())], response.get("etag")
 
-		video_ids = [item["contentDetails"]["videoId"] for item in feed]
-		url = self._get_videos_url(video_ids)
+	def _get_videos(self, video_ids, api_key, **kwargs):
+		"""
+		Resolves videos, requesting only those not already resolved by any YouTube handler.
+		Handlers resolve videos one at a time, so a video in the playlists of several handlers
+		running concurrently is requested once.
+		:return: A dict of video IDs to video resources
+		"""
+		with _video_cache.filling:
+			videos = _video_cache.get_all(video_ids)
+			missing = [video_id for video_id in video_ids if video_id not in videos]
+			for i in range(0, len(missing), 50):
+				chunk = missing[i:i+50]
+				if not self._has_quota(api_key, 1):
+					break
+				response = self.request(self._get_videos_url(chunk), json=True, **kwargs)
+				if response is None:
+					error(f"Cannot get video information for {self.name}")
+					continue
+				if not _verify_feed(response):
+					warning("Parsed feed could not be verified, may have unexpected results")
+				for item in response.get("items", list()):
+					videos[item["id"]] = item
+					_video_cache.add(item)
+		debug(f"  {len(video_ids)} videos, {len(missing)} requested")
+		return videos
 
-		# Request videos information
-		response = self.request(url, json=True, **kwargs)
-		if response is None:
-			error(f"Cannot get video information for {self.name}/{show_key}")
-			return list()
+	def _get_api_key(self):
+		if "api_key" not in self.config or not self.config["api_key"]:
+			error("  Missing API key for access to Youtube channel")
+			return None
+		return self.config["api_key"]
 
-		# Return feed
-		if not _verify_feed(response):
-			warning("Parsed feed could not be verified, may have unexpected results")
-		return response.get("items", list())
+	def _has_quota(self, api_key, units):
+		daily_quota = int(self.config.get("daily_quota", "10000"))
+		quota_reserve = int(self.config.get("quota_reserve", "1000"))
+		if not _quota.has(api_key, units, daily_quota - quota_reserve):
+			warning(f"  Daily quota reserve reached for {self.name}, skipping request")
+			return False
+		return True
+
+	def _request_sent(self, url):
+		# Responses reused within the run or reported unchanged don't reach the API
+		api_key = self._get_api_key()
+		if api_key is not None:
+			_quota.spend(api_key, 1)
 
 	def _get_feed_url(self, show_key):
 		# Show key is the channel ID
-		if "api_key" not in self.config or not self.config["api_key"]:
-			error("  Missing API key for access to Youtube channel")
+		api_key = self._get_api_key()
+		if api_key is None:
 			return None
-		api_key = self.config["api_key"]
 		if show_key is not None:
 			return self._playlist_api_query.format(id=show_key, key=api_key)
 		else:
@@ -80,10 +153,9 @@ class ServiceHandler(AbstractServiceHandler):
 
 	def _get_videos_url(self, video_ids):
 		# Videos ids is a list of all videos in feed
-		if "api_key" not in self.config or not self.config["api_key"]:
-			error("  Missing API key for access to Youtube channel")
+		api_key = self._get_api_key()
+		if api_key is None:
 			return None
-		api_key = self.config["api_key"]
 		if video_ids:
 			return self._videos_api_query.format(id=','.join(video_ids), key=api_key)
 		else:
@@ -106,6 +178,115 @@ class ServiceHandler(AbstractServiceHandler):
 			return match.group(1)
 		return None
 
+# Shared by all YouTube handlers
+
+class _VideoCache:
+	"""
+	Videos already resolved by any YouTube handler. Only videos that can't change status anymore
+	(public or unlisted and not upcoming or live) are kept.
+	"""
+	def __init__(self, max_size=5000):
+		self._videos = OrderedDict()
+		self._max_size = max_size
+		self._lock = Lock()
+		# Held by a handler while it resolves videos missing from the cache
+		self.filling = Lock()
+
+	def get_all(self, video_ids):
+		with self._lock:
+			return {video_id: self._videos[video_id] for video_id in video_ids if video_id in self._videos}
+
+	def add(self, video):
+		if video["status"]["privacyStatus"] == "private" or video["snippet"]["liveBroadcastContent"] != "none":
+			return
+		with self._lock:
+			self._videos[video["id"]] = video
+			self._videos.move_to_end(video["id"])
+			while len(self._videos) > self._max_size:
+				self._videos.popitem(last=False)
+
+_video_cache = _VideoCache()
+
+try:
+	from zoneinfo import ZoneInfo
+	_quota_timezone = ZoneInfo("America/Los_Angeles")
+except Exception:
+	# No time zone database, Pacific standard time is off by an hour during DST
+	_quota_timezone = timezone(timedelta(hours=-8))
+
+class _QuotaCounter:
+	"""
+	Daily quota used by each API key, persisted so separate runs add up.
+	YouTube resets the quota at midnight Pacific time.
+	"""
+	def __init__(self):
+		self._lock = Lock()
+
+	def has(self, api_key, units, limit):
+		"""
+		Checks if units can be spent from the daily quota of an API key without going over a limit.
+		"""
+		with self._lock:
+			return self._get_used(api_key) + units <= limit
+
+	def spend(self, api_key, units):
+		"""
+		Counts units against the daily quota of an API key.
+		"""
+		with self._lock:
+			used = self._get_used(api_key)
+			get_disk_cache("youtube").set(self._key(api_key), {"day": self._today(), "used": used + units})
+
+	def _get_used(self, api_key):
+		entry = get_disk_cache("youtube").get(self._key(api_key)) or dict()
+		return entry.get("used", 0) if entry.get("day") == self._today() else 0
+
+	@staticmethod
+	def _key(api_key):
+		return "quota:" + hashlib.sha1(api_key.encode("utf-8")).hexdigest()
+
+	@staticmethod
+	def _today():
+		return datetime.now(_quota_timezone).date().isoformat()
+
+_quota = _QuotaCounter()
+
+class _SeenVideos:
+	"""
+	Videos of each playlist already classified, with the playlist etag, persisted between runs.
+	Kept in the cache directory since handlers run on worker threads, which can't use the database.
+	"""
+	def get(self, playlist_id):
+		"""
+		:return: A dict with the etag of the playlist and a dict of its video IDs to classified videos
+		"""
+		record = get_disk_cache("youtube").get("playlist:" + playlist_id)
+		if record is None:
+			return {"etag": None, "videos": dict()}
+		return record
+
+	def set(self, playlist_id, etag, videos):
+		get_disk_cache("youtube").set("playlist:" + playlist_id, {"etag": etag, "videos": videos})
+
+_seen_videos = _SeenVideos()
+_pending = {"status": "pending"}
+
+def _classify_video(video, show_key):
+	"""
+	:return: The video as stored in the seen videos: pending if it may still change, excluded,
+		or valid with the data of its episode
+	"""
+	if video["status"]["privacyStatus"] == "private" or video["snippet"]["liveBroadcastContent"] == "upcoming":
+		return _pending
+	episode = _digest_episodes([video], show_key)
+	if len(episode) == 0:
+		return {"status": "excluded"}
+	episode = episode[0]
+	return {"status": "valid", "number": episode.number, "link": episode.link, "date": episode.date.isoformat()}
+
+def _to_episode(video):
+	return Episode(video["number"], None, video["link"], datetime.fromisoformat(video["date"]))
+
 # Episode feeds format
 
 def _verify_feed(feed):
@@ -119,17 +300,36 @@ def _verify_feed(feed):
 	debug("  Feed verified")
 	return True
 
-_excludors = [re.compile(x, re.I) for x in [
+_excludor = re.compile("|".join("(?:{})".format(x) for x in [
 	"(?:[^a-zA-Z]|^)(?:PV|OP|ED)(?:[^a-zA-Z]|$)",
 	"blu.?ray",
 	"preview",
-]]
+]), re.I)
 
-_num_extractors = [re.compile(x, re.I) for x in [
+# Alternatives are tried in order at the start of the title, the same as matching each pattern in turn
+_num_extractor = re.compile("|".join("(?:{})".format(x) for x in [
 	r".*\D(\d{2,3})(?:\D|$)",
 	r".*episode (\d+)(?:\D|$)",
 	r".*S(?:\d+)E(\d+)(?:\D|$)",
-]]
+]), re.I)
+
+def _digest_episodes(episode_datas, show_key):
+	# Extract valid episodes from feed and digest
+	episodes = []
+	for episode_data in episode_datas:
+		if _is_valid_episode(episode_data, show_key):
+			try:
+				episode = _digest_episode(episode_data)
+				if episode is not None:
+					episodes.append(episode)
+			except:
+				exception(f"Problem digesting episode for Youtube/{show_key}")
+
+	if len(episode_datas) > 0:
+		debug("  {} episodes found, {} valid".format(len(episode_datas), len(episodes)))
+	else:
+		debug("  No episodes found")
+	return episodes
 
 def _is_valid_episode(feed_episode, show_id):
 	if feed_episode["status"]["privacyStatus"] == "private":
@@ -142,10 +342,11 @@ def _is_valid_episode(feed_episode, show_id):
 	if len(title) == 0:
 		info("  Video was exluded (no title found)")
 		return False
-	if any(ex.search(title) is not None for ex in _excludors):
+	excluded, number = _classify_title(title)
+	if excluded:
 		info("  Video was exluded (excludors)")
 		return False
-	if all(num.match(title) is None for num in _num_extractors):
+	if number is None:
 		info("  Video was excluded (no episode number found)")
 		return False
 	return True
@@ -166,15 +367,24 @@ def _digest_episode(feed_episode):
 	link = _video_url.format(video_id=feed_episode["id"])
 	return Episode(episode_num, None, link, date)
 
+@lru_cache(maxsize=4096)
+def _classify_title(name):
+	"""
+	Classifies a video title in a single pass, cached since playlists return the same videos every run.
+	:return: A tuple of whether the title is excluded and its episode number, or None if not found
+	"""
+	if _excludor.search(name) is not None:
+		return True, None
+	match = _num_extractor.match(name)
+	if match is not None:
+		return False, int(next(num for num in match.groups() if num is not None))
+	return False, None
+
 def _extract_episode_num(name):
 	debug(f"Extracting episode number from \"{name}\"")
-	if any(ex.search(name) is not None for ex in _excludors):
-		return None
-	for regex in _num_extractors:
-		match = regex.match(name)
-		if match is not None:
-			num = int(match.group(1))
-			debug(f"  Match found, num={num}")
-			return num
-	debug("  No match found")
-	return none
+	num = _classify_title(name)[1]
+	if num is not None:
+		debug(f"  Match found, num={num}")
+	else:
+		debug("  No match found")
+	return num
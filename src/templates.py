@@ -0,0 +1,72 @@
+from logging import debug
+from functools import lru_cache
+from string import Formatter
+import re
+
+_formatter = Formatter()
+_block_separator = re.compile(r"(\n\s*\n)")
+
+class Template:
+	"""
+	A post template compiled into blocks (paragraphs), each a list of literal text and fields.
+	"""
+	def __init__(self, text):
+		pieces = _block_separator.split(text)
+		self._blocks = [list(_formatter.parse(block)) for block in pieces[0::2]]
+		self._separators = pieces[1::2]
+		self.fields = frozenset(_field_root(field) for block in self._blocks for _, field, _, _ in block if field is not None)
+
+	def render(self, values):
+		"""
+		Renders the template in a single pass.
+		Blocks without literal text whose fields are all empty are dropped, unknown fields are left as-is.
+		:param values: A dict of field names to values
+		:return: The rendered text
+		"""
+		output = list()
+		for n, block in enumerate(self._blocks):
+			text, has_content = _render_block(block, values)
+			if not has_content:
+				continue
+			if len(output) > 0:
+				output.append(self._separators[n-1])
+			output.append(text)
+		return "".join(output)
+
+@lru_cache(maxsize=64)
+def compile_template(text) -> Template:
+	"""
+	Compiles a template, once per distinct text.
+	:param text: The template text, using str.format placeholders
+	:return: The compiled template
+	:raises ValueError: If the template isn't a valid format string
+	"""
+	debug("Compiling template of {} characters".format(len(text)))
+	return Template(text)
+
+def _render_block(block, values):
+	parts = list()
+	has_content = False
+	for literal, field, format_spec, conversion in block:
+		parts.append(literal)
+		if literal.strip():
+			has_content = True
+		if field is None:
+			continue
+
+		try:
+			value, _ = _formatter.get_field(field, (), values)
+		except (KeyError, IndexError, AttributeError):
+			text = _placeholder(field, format_spec, conversion)
+		else:
+			text = _formatter.format_field(_formatter.convert_field(value, conversion), format_spec)
+		parts.append(text)
+		if text.strip():
+			has_content = True
+	return "".join(parts), has_content
+
+def _field_root(field):
+	return re.split(r"[.\[]", field, maxsplit=1)[0]
+
+def _placeholder(field, format_spec, conversion):
+	return "{" + field + ("!" + conversion if conversion else "") + (":" + format_spec if format_spec else "") + "}"
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+
+from feedparser import FeedParserDict
+
+from data.models import Stream
+from services.stream import crunchyroll
+
+def _entry(slug, number, age):
+	published = datetime.utcnow() - age
+	return FeedParserDict(
+		link="http://www.crunchyroll.com/{}/episode-{}-title-{}".format(slug, number, 700000 + number),
+		title="Show Episode {} - Title".format(number),
+		crunchyroll_episodenumber=str(number),
+		published_parsed=published.timetuple(),
+	)
+
+def _stream(id, show_key):
+	return Stream(id, 1, None, None, show_key, "", 0, 0, 1)
+
+def _handler(global_feed):
+	handler = crunchyroll.ServiceHandler()
+	handler.show_feeds_requested = list()
+	def get_feed_episodes(show_key, **kwargs):
+		if show_key is None:
+			return global_feed
+		handler.show_feeds_requested.append(show_key)
+		return [_entry(show_key, 1, timedelta(hours=1))]
+	handler._get_feed_episodes = get_feed_episodes
+	return handler
+
+def test_get_slug():
+	assert crunchyroll._get_slug("http://www.crunchyroll.com/my-show/episode-3-title-700003") == "my-show"
+	assert crunchyroll._get_slug("https://www.crunchyroll.com/series/GY8VEQ95Y") == "series"
+	assert crunchyroll._get_slug("https://example.com/") is None
+
+def test_covers_recent_episodes():
+	assert crunchyroll._covers_recent_episodes([_entry("a", 1, timedelta(hours=1)), _entry("b", 1, timedelta(days=3))])
+	assert not crunchyroll._covers_recent_episodes([_entry("a", 1, timedelta(hours=1))])
+	assert not crunchyroll._covers_recent_episodes([])
+
+def test_recent_episodes_matched_by_slug():
+	handler = _handler([_entry("My-Show", 4, timedelta(hours=2)), _entry("other", 1, timedelta(days=3))])
+	shown, missing = _stream(1, "my-show"), _stream(2, "absent-show")
+	episodes = handler.get_recent_episodes([shown, missing])
+	assert [episode.number for episode in episodes[shown]] == [4]
+	# The feed goes back far enough, a stream missing from it has no recent episode
+	assert episodes[missing] == []
+	assert handler.show_feeds_requested == []
+
+def test_recent_episodes_fallback():
+	handler = _handler([_entry("my-show", 4, timedelta(hours=2))])
+	missing, series, unknown = _stream(1, "absent-show"), _stream(2, "series/GY8VEQ95Y"), _stream(3, None)
+	episodes = handler.get_recent_episodes([missing, series, unknown])
+	assert sorted(handler.show_feeds_requested, key=str) == ["absent-show", "series/GY8VEQ95Y"]
+	assert [episode.number for episode in episodes[missing]] == [1]
+	assert [episode.number for episode in episodes[series]] == [1]
+
+def test_recent_episodes_failed_fallback():
+	handler = _handler([_entry("my-show", 4, timedelta(hours=2))])
+	handler._get_feed_episodes = lambda show_key, **kwargs: [] if show_key is None else None
+	missing = _stream(1, "absent-show")
+	# A feed that couldn't be requested isn't reported as a stream without episodes
+	assert handler.get_recent_episodes([missing])[missing] is None